@@ -0,0 +1,83 @@
+#!/usr/bin/python3
+#
+# Compare the batch decoder of lesyd_batch.py to the decoding of the frames
+# one by one (CRC check and RegisterDecoder.decode as done by the devices).
+#
+# The frames are CRC-valid ReadInputRegisters responses with random
+# registers and a few corrupted ones. The decoded fields of both methods
+# are compared before the timings are reported.
+#
+# Usage: python3 bench/bench_batch.py [--frames 10000,100000] [--corrupt 0.01]
+#
+
+import os
+import sys
+import time
+import random
+import struct
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import lesyd
+import lesyd_batch
+
+def make_frame(words):
+    payload = bytes([lesyd_batch.MODBUS_CHANNEL, lesyd_batch.FUNC_READ_INPUT_REGISTERS,
+                     0, 0, 0, len(words)]) + struct.pack('>{}H'.format(len(words)), *words)
+    return payload + lesyd.modbus_crc16(payload, len(payload)).to_bytes(2, 'big')
+
+def make_frames(count, corrupt):
+    rng = random.Random(42)
+    frames = []
+    for i in range(count):
+        words = [ rng.randrange(0, 1000) for r in range(lesyd_batch.REGISTER_COUNT) ]
+        words[lesyd.IREG_STATUS_BITS] = rng.randrange(0, 1<<16)
+        frame = make_frame(words)
+        if rng.random() < corrupt:
+            frame = frame[:-1] + bytes([frame[-1] ^ 0xFF])
+        frames.append(frame)
+    return frames
+
+# The reference: one frame at a time.
+def decode_one_by_one(frames):
+    decoder = lesyd.compile_register_map(tuple(lesyd.INPUT_REGISTER_MAP), lesyd_batch.REGISTER_COUNT)
+    crc16 = lesyd.modbus_crc16
+    rows = []
+    for frame in frames:
+        if crc16(frame, len(frame)-2) != ((frame[-2]<<8) | frame[-1]):
+            continue
+        rows.append(decoder.decode(frame, lesyd_batch.FRAME_HEADER))
+    return rows
+
+def check(rows, columns):
+    names = [ field for field, value in rows[0] ] if rows else []
+    assert len(rows) == len(columns['index']), "not the same number of valid frames"
+    for name in names:
+        expected = [ dict(row)[name] for row in rows ]
+        actual = columns[name].tolist()
+        assert expected == actual, "mismatch for field '{}'".format(name)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frames', default='10000,100000')
+    parser.add_argument('--corrupt', type=float, default=0.01, help="The fraction of frames with a bad CRC")
+    args = parser.parse_args()
+
+    for count in args.frames.split(','):
+        frames = make_frames(int(count), args.corrupt)
+
+        start = time.perf_counter()
+        rows = decode_one_by_one(frames)
+        single = time.perf_counter() - start
+
+        start = time.perf_counter()
+        columns = lesyd_batch.drop_invalid(lesyd_batch.decode_frames(frames))
+        batch = time.perf_counter() - start
+
+        check(rows, columns)
+        print("%7d frames: one by one %8.3fs (%9.0f frames/s)  batch %8.3fs (%9.0f frames/s)  x%.1f" %
+              (len(frames), single, len(frames)/single, batch, len(frames)/batch, single/batch))
+
+if __name__ == "__main__":
+    main()
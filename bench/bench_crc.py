@@ -0,0 +1,65 @@
+#!/usr/bin/python3
+#
+# Measure the cost of the Modbus CRC16 per frame.
+#
+# Usage: python3 bench/bench_crc.py [--count N]
+#
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import lesyd
+
+# The original bit by bit implementation (kept as a reference)
+def modbus_crc16_bitwise(buf, size:int) -> int:
+    crc = 0xFFFF
+    for i in range(size):
+        crc ^= buf[i]
+        for bit in range(8):
+            if crc & 0x0001:
+                crc >>= 1
+                crc ^= 0xA001
+            else:
+                crc >>= 1
+    return crc
+
+def bench(name, func, frame, count):
+    size = len(frame)
+    start = time.perf_counter()
+    for i in range(count):
+        func(frame, size)
+    elapsed = time.perf_counter() - start
+    print("  %-10s %8.2f us/frame  %10.0f frames/s" % (name, elapsed/count*1e6, count/elapsed))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=20000)
+    args = parser.parse_args()
+
+    # A full register dump: channel, function, first, count, 80 words and the CRC.
+    response = bytes([0x11, 0x04, 0, 0, 0, 80]) + bytes(range(160)) + b'\0\0'
+    request  = bytes(lesyd.encode_modbus_request(0x11, 0x04, 0, 80))
+
+    implementations = [
+        ('bitwise', modbus_crc16_bitwise),
+        ('table',   lesyd.modbus_crc16_table),
+    ]
+    if lesyd.modbus_crc16_native:
+        implementations.append( ('native', lesyd.modbus_crc16_native) )
+
+    for impl_name, func in implementations:
+        if func(response, len(response)) != modbus_crc16_bitwise(response, len(response)):
+            print("ERROR: %s does not match the reference implementation" % impl_name)
+            sys.exit(1)
+
+    for frame_name, frame in [ ('request', request), ('response', response) ]:
+        print("%s (%d bytes)" % (frame_name, len(frame)))
+        for impl_name, func in implementations:
+            bench(impl_name, func, frame, args.count)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+#!/usr/bin/python3
+#
+# Compare the 'threads' and 'asyncio' engines of LeSyd.
+#
+# A producer thread sends ReadInputRegisters responses for all devices
+# through a socket pair, and a fake MQTT client reads them either from its
+# own network thread (like paho's loop_start) or from the asyncio loop (like
+# paho's external loop API). The latency is measured from the write on the
+# socket to the call of Device.process_sydpower_response(), and the CPU
+# time is the CPU time of the process minus that of the producer.
+#
+# Usage: python3 bench/bench_engines.py [--devices 1,10,100] [--rate 10] [--duration 5]
+#
+
+import os
+import sys
+import time
+import random
+import struct
+import socket
+import argparse
+import tempfile
+import threading
+import selectors
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import lesyd
+
+# Header of the messages sent through the socket pair: send time, topic length and payload length.
+HEADER = struct.Struct('>dHH')
+
+STOP_TOPIC = 'bench/stop'
+
+class ReasonCode:
+    is_failure = False
+
+class MessageInfo:
+    def wait_for_publish(self, timeout=None):
+        pass
+
+class Message:
+    def __init__(self, topic, payload, sent):
+        self.topic   = topic
+        self.payload = payload
+        self.sent    = sent
+
+# A fake MQTT client that receives its messages from a socket pair.
+#
+# It implements the part of the paho API used by both engines.
+class SocketClient:
+
+    def __init__(self):
+        self.rsock, self.wsock = socket.socketpair()
+        self.rsock.setblocking(False)
+        self.buffer     = b''
+        self.connected  = threading.Event()
+        self.running    = False
+        self.publications = 0
+        self.on_socket_open = None
+
+    def username_pw_set(self, username, password):
+        pass
+
+    def will_set(self, topic, payload=None, qos=0, retain=False):
+        pass
+
+    def connect_async(self, host, port, keepalive=60):
+        pass
+
+    def is_connected(self):
+        return self.connected.is_set()
+
+    def subscribe(self, topic, qos=0):
+        return (0, 1)
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.publications += 1
+        return MessageInfo()
+
+    def disconnect(self):
+        pass
+
+    # The 'threads' engine.
+    def loop_start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.network_thread, daemon=True)
+        self.thread.start()
+
+    def loop_stop(self):
+        self.running = False
+
+    def network_thread(self):
+        self.connect()
+        selector = selectors.DefaultSelector()
+        selector.register(self.rsock, selectors.EVENT_READ)
+        while self.running:
+            selector.select(0.1)
+            self.loop_read()
+
+    # The 'asyncio' engine.
+    def reconnect(self):
+        self.on_socket_open(self, None, self.rsock)
+        self.connect()
+
+    def loop_write(self):
+        pass
+
+    def loop_misc(self):
+        return lesyd.mqtt.MQTT_ERR_SUCCESS
+
+    def connect(self):
+        self.on_connect(self, None, None, ReasonCode(), None)
+        self.connected.set()
+
+    def loop_read(self):
+        try:
+            while True:
+                data = self.rsock.recv(65536)
+                if not data:
+                    break
+                self.buffer += data
+        except BlockingIOError:
+            pass
+        buffer = self.buffer
+        pos = 0
+        while len(buffer) - pos >= HEADER.size:
+            sent, tlen, plen = HEADER.unpack_from(buffer, pos)
+            end = pos + HEADER.size + tlen + plen
+            if end > len(buffer):
+                break
+            topic = buffer[pos+HEADER.size:pos+HEADER.size+tlen].decode()
+            payload = buffer[end-plen:end]
+            self.on_message(self, None, Message(topic, payload, sent))
+            pos = end
+        self.buffer = buffer[pos:]
+
+    # Called by the producer thread
+    def send(self, topic, payload):
+        topic = topic.encode()
+        self.wsock.sendall(HEADER.pack(time.perf_counter(), len(topic), len(payload)) + topic + payload)
+
+def make_frame(words):
+    payload = bytes([0x11, 4, 0, 0, 0, len(words)]) + b''.join(struct.pack('>H', w) for w in words)
+    crc = lesyd.modbus_crc16(payload, len(payload))
+    return payload + struct.pack('>H', crc)
+
+def make_frames(variants):
+    frames = []
+    for i in range(variants):
+        words = [ random.randrange(0, 1000) for r in range(80) ]
+        words[56] = random.randrange(0, 1000)   # battery SoC
+        frames.append(make_frame(words))
+    return frames
+
+def make_lesyd(count, engine):
+    config = "global:\n  loglevel: WARNING\n"
+    config += "mqtt_client:\n  hostname: localhost\ndevices:\n"
+    for i in range(count):
+        config += "  '{:012x}':\n    name: dev{}\n    preset: F2400-B\n".format(0x7c2c00000000+i, i)
+    with tempfile.NamedTemporaryFile('w', suffix='.yaml', delete=False) as f:
+        f.write(config)
+    try:
+        return lesyd.LeSyd(['-c', f.name, '--engine', engine])
+    finally:
+        os.unlink(f.name)
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    return values[min(len(values)-1, int(len(values)*p))]
+
+def bench(count, engine, rate, duration):
+    main = make_lesyd(count, engine)
+    client = SocketClient()
+
+    def create_mqtt_clients():
+        main.mqtt_client   = client
+        main.mqtt_sydpower = client
+        main.mqtt_clients  = [ client ]
+        main.start_mqtt_client(client, main.mqtt_client_config)
+    main.create_mqtt_clients = create_mqtt_clients
+
+    latencies = []
+    def measured(handler):
+        def wrapper(msg):
+            latencies.append(time.perf_counter() - msg.sent)
+            handler(msg)
+        return wrapper
+    for dev in main.devices:
+        main.message_handlers[dev.topic_response] = measured(dev.process_sydpower_response)
+
+    def stop(msg):
+        main.result = 0
+    main.message_handlers[STOP_TOPIC] = stop
+
+    frames = make_frames(8)
+    producer_cpu = [0.0]
+    def producer():
+        client.connected.wait()
+        period = 1.0 / (rate * count)
+        start = time.perf_counter()
+        n = 0
+        while True:
+            when = start + n * period
+            if when - start >= duration:
+                break
+            delay = when - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            dev = main.devices[n % count]
+            client.send(dev.topic_response, frames[n % len(frames)])
+            n += 1
+        client.send(STOP_TOPIC, b'')
+        producer_cpu[0] = time.thread_time()
+
+    thread = threading.Thread(target=producer)
+    cpu = time.process_time()
+    thread.start()
+    try:
+        main.loop()
+    except SystemExit:
+        pass
+    thread.join()
+    cpu = time.process_time() - cpu - producer_cpu[0]
+
+    latencies.sort()
+    print("%-8s %5d devices: %7d msgs  cpu %6.3f ms/device/s  latency p50 %7.1f us  p99 %7.1f us  max %8.1f us" %
+          (engine, count, len(latencies), cpu/count/duration*1e3,
+           percentile(latencies, 0.50)*1e6, percentile(latencies, 0.99)*1e6,
+           (latencies[-1] if latencies else 0)*1e6))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--devices', default='1,10,100')
+    parser.add_argument('--engines', default='threads,asyncio')
+    parser.add_argument('--rate', type=float, default=10, help="responses per device per second")
+    parser.add_argument('--duration', type=float, default=5)
+    args = parser.parse_args()
+    for count in args.devices.split(','):
+        for engine in args.engines.split(','):
+            bench(int(count), engine, args.rate, args.duration)
+
+if __name__ == "__main__":
+    main()
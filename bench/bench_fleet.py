@@ -0,0 +1,290 @@
+#!/usr/bin/python3
+#
+# End-to-end benchmark of LeSyd driving fleets of simulated stations.
+#
+# LeSyd runs with the 'memory' MQTT transport so no socket is involved.
+# The stations are simulated by lesyd_sim.Simulator on the same in-memory
+# broker and commands are published periodically on
+# 'lesyd/DEVICE/state/set/usb_output'.
+#
+# With '--clock real', LeSyd runs its main loop in real time. With
+# '--clock virtual', it is driven by a ManualClock as fast as possible so
+# the duration is in simulated seconds.
+#
+# Reported for each fleet size:
+#   - the number of register responses processed per (wall) second
+#   - the CPU time used by LeSyd per device and per simulated second (the
+#     simulator is excluded)
+#   - the maximal resident set size of the process
+#   - the latency from the publication of a command to the publication of
+#     the WriteHoldingRegister request
+#   - the latency from the publication of a register response to the
+#     publication of the device state
+#
+# Each fleet size runs in its own process and the results are written as
+# JSON so that they can be compared across versions.
+#
+# Usage: python3 bench/bench_fleet.py [--devices 1,10,100,1000] [--duration 20] [--clock real|virtual] [--output results.json]
+#
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import lesyd
+import lesyd_sim
+
+BROKER = 'bench'
+
+# Received by LeSyd via its 'lesyd/+/status' subscription
+STOP_TOPIC = 'lesyd/bench/status'
+
+# Measure the latencies from the publications seen by the broker.
+class Probe:
+
+    def __init__(self, devices):
+        self.by_request = { dev.topic_request: dev for dev in devices }
+        self.by_response = { dev.topic_response: dev for dev in devices }
+        self.by_state = { dev.topic_state: dev for dev in devices }
+        self.by_command = {}
+        self.reset()
+
+    def reset(self):
+        self.response_time = {}   # dev -> time of the last unpublished response
+        self.command_time  = {}   # dev -> time of the pending command
+        self.responses = 0
+        self.state_latencies   = []
+        self.command_latencies = []
+
+    def published(self, topic, payload):
+        now = time.perf_counter()
+        dev = self.by_response.get(topic)
+        if dev:
+            self.responses += 1
+            self.response_time[dev] = now
+            return
+        dev = self.by_state.get(topic)
+        if dev:
+            sent = self.response_time.pop(dev, None)
+            if sent is not None:
+                self.state_latencies.append(now - sent)
+            return
+        dev = self.by_request.get(topic)
+        if dev:
+            if payload[1] == lesyd.Device.FUNC_WRITE_HOLDING_REGISTER:
+                sent = self.command_time.pop(dev, None)
+                if sent is not None:
+                    self.command_latencies.append(now - sent)
+            return
+        dev = self.by_command.get(topic)
+        if dev:
+            self.command_time.setdefault(dev, now)
+
+def percentiles(values):
+    values = sorted(values)
+    def at(p):
+        return round(values[min(len(values)-1, int(len(values)*p))]*1e3, 3) if values else None
+    return {
+        'count': len(values),
+        'p50':   at(0.50),
+        'p90':   at(0.90),
+        'p99':   at(0.99),
+        'max':   round(values[-1]*1e3, 3) if values else None,
+    }
+
+def make_lesyd(macs, input_refresh, clock):
+    config = "global:\n  loglevel: WARNING\n"
+    config += "mqtt_client:\n  transport: memory\n  hostname: {}\ndevices:\n".format(BROKER)
+    for i, mac in enumerate(macs):
+        config += "  '{}':\n    name: sim{}\n    preset: F2400-B\n".format(mac, i)
+        if input_refresh:
+            config += "    input_refresh: {}\n".format(input_refresh)
+    with tempfile.NamedTemporaryFile('w', suffix='.yaml', delete=False) as f:
+        f.write(config)
+    try:
+        return lesyd.LeSyd(['-c', f.name], clock=clock)
+    finally:
+        os.unlink(f.name)
+
+# The simulated stations on the in-memory broker
+class Stations:
+
+    def __init__(self, macs, clock):
+        self.simulator = lesyd_sim.Simulator(macs)
+        self.clock  = clock
+        self.cpu    = 0.0   # CPU time used by the simulator
+        self.client = lesyd.memory_broker(BROKER).client()
+        self.client.on_message = self.on_message
+        self.client.reconnect()
+        self.client.subscribe('+/client/request/data')
+
+    def on_message(self, client, userdata, msg):
+        cpu = time.thread_time()
+        result = self.simulator.process_request(msg.topic, msg.payload, self.clock())
+        self.cpu += time.thread_time() - cpu
+        if result:
+            client.publish(result[1], result[2])
+
+def command_topic(dev):
+    return dev.topic_command + 'usb_output'
+
+def command_payload(n, count):
+    return 'ON' if (n//count) % 2 else 'OFF'
+
+# Run in real time: LeSyd runs its main loop while a thread publishes the commands.
+def run_real(main, stations, probe, duration, warmup, command_rate):
+    broker = lesyd.memory_broker(BROKER)
+    count = len(main.devices)
+
+    def stop(msg):
+        main.result = 0
+    main.message_handlers[STOP_TOPIC] = stop
+
+    results = {}
+    def driver():
+        time.sleep(warmup)
+        probe.reset()
+        cpu = time.process_time() - stations.cpu
+        start = time.perf_counter()
+        n = 0
+        while True:
+            now = time.perf_counter()
+            if now - start >= duration:
+                break
+            if command_rate:
+                when = start + n / command_rate
+                if when > now:
+                    time.sleep(min(when - now, start + duration - now))
+                    continue
+                dev = main.devices[n % count]
+                broker.publish(command_topic(dev), command_payload(n, count))
+                n += 1
+            else:
+                time.sleep(start + duration - now)
+        results['elapsed'] = time.perf_counter() - start
+        results['simulated'] = results['elapsed']
+        results['cpu'] = time.process_time() - stations.cpu - cpu
+        broker.publish(STOP_TOPIC, '')
+
+    thread = threading.Thread(target=driver)
+    thread.start()
+    try:
+        main.loop()
+    except SystemExit:
+        pass
+    thread.join()
+    return results
+
+# Run as fast as possible with a ManualClock.
+def run_virtual(main, stations, probe, duration, warmup, command_rate):
+    broker = lesyd.memory_broker(BROKER)
+    count = len(main.devices)
+    clock = main.clock
+
+    main.start()
+    main.run_until(clock() + warmup)
+    probe.reset()
+
+    results = {}
+    cpu = time.process_time() - stations.cpu
+    start_wall = time.perf_counter()
+    start = clock()
+    period = 1.0 / command_rate if command_rate else duration
+    n = 0
+    while clock() - start < duration:
+        main.run_until(min(start + n*period, start + duration))
+        if command_rate and clock() - start < duration:
+            dev = main.devices[n % count]
+            broker.publish(command_topic(dev), command_payload(n, count))
+        n += 1
+    results['elapsed'] = time.perf_counter() - start_wall
+    results['simulated'] = clock() - start
+    results['cpu'] = time.process_time() - stations.cpu - cpu
+    return results
+
+# Run LeSyd with 'count' stations and return the results.
+def run(count, mode, duration, warmup, command_rate, input_refresh):
+    macs = lesyd_sim.make_macs('7c2c00000000', count)
+    clock = lesyd.ManualClock(time.time()) if mode == 'virtual' else time.time
+    main = make_lesyd(macs, input_refresh, clock)
+
+    probe = Probe(main.devices)
+    for dev in main.devices:
+        probe.by_command[command_topic(dev)] = dev
+    lesyd.memory_broker(BROKER).observers.append(probe.published)
+
+    stations = Stations(macs, clock)
+    if mode == 'virtual':
+        results = run_virtual(main, stations, probe, duration, warmup, command_rate)
+    else:
+        results = run_real(main, stations, probe, duration, warmup, command_rate)
+
+    return {
+        'devices':          count,
+        'clock':            mode,
+        'duration':         round(results['simulated'], 3),
+        'elapsed':          round(results['elapsed'], 3),
+        'responses':        probe.responses,
+        'msgs_per_s':       round(probe.responses / results['elapsed'], 1),
+        'cpu_ms_per_device_s': round(results['cpu'] / count / results['simulated'] * 1e3, 4),
+        'max_rss_kb':       resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'command_latency_ms': percentiles(probe.command_latencies),
+        'state_latency_ms': percentiles(probe.state_latencies),
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--devices', default='1,10,100,1000')
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--clock', choices=['real','virtual'], default='real')
+    parser.add_argument('--warmup', type=float, default=3)
+    parser.add_argument('--commands', type=float, default=5, help="commands per second (whole fleet)")
+    parser.add_argument('--input-refresh', type=int, default=3)
+    parser.add_argument('--output', default=None, help="write the results to that JSON file")
+    parser.add_argument('--run', type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run is not None:
+        result = run(args.run, args.clock, args.duration, args.warmup, args.commands, args.input_refresh)
+        print(json.dumps(result))
+        return
+
+    runs = []
+    for count in args.devices.split(','):
+        command = [ sys.executable, os.path.abspath(__file__), '--run', count, '--clock', args.clock,
+                    '--duration', str(args.duration), '--warmup', str(args.warmup),
+                    '--commands', str(args.commands), '--input-refresh', str(args.input_refresh) ]
+        output = subprocess.run(command, stdout=subprocess.PIPE, check=True, text=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        runs.append(result)
+        print("%5d devices: %8.1f msgs/s  cpu %7.4f ms/device/s  rss %7d KB  "
+              "command p50 %s ms p99 %s ms  state p50 %s ms p99 %s ms" %
+              (result['devices'], result['msgs_per_s'], result['cpu_ms_per_device_s'], result['max_rss_kb'],
+               result['command_latency_ms']['p50'], result['command_latency_ms']['p99'],
+               result['state_latency_ms']['p50'], result['state_latency_ms']['p99']))
+
+    report = {
+        'benchmark': 'fleet',
+        'time':      time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python':    platform.python_version(),
+        'settings':  { 'clock': args.clock, 'duration': args.duration, 'warmup': args.warmup,
+                       'commands': args.commands, 'input_refresh': args.input_refresh },
+        'runs':      runs,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
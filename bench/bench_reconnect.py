@@ -0,0 +1,93 @@
+#!/usr/bin/python3
+#
+# Measure the number of SUBSCRIBE requests and the time needed by
+# LeSyd.on_connect() to get ready after a (re)connection, and the cost of
+# the topic dispatch in LeSyd.on_message().
+#
+# Usage: python3 bench/bench_reconnect.py [--devices 1,10,50,100] [--ha-discovery]
+#
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import lesyd
+
+# Subscriptions per device before the wildcard subscriptions:
+# 3 sydpower topics, 12 commands and the status topic.
+LEGACY_SUBSCRIPTIONS_PER_DEVICE = 16
+
+class ReasonCode:
+    is_failure = False
+
+class Message:
+    def __init__(self, topic, payload):
+        self.topic   = topic
+        self.payload = payload
+
+# A MQTT client that only counts what would be sent to the broker.
+class CountingClient:
+
+    def __init__(self):
+        self.subscriptions = 0
+        self.publications  = 0
+
+    def subscribe(self, topic, qos=0):
+        self.subscriptions += 1
+        return (0, self.subscriptions)
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.publications += 1
+
+    def is_connected(self):
+        return True
+
+def make_lesyd(count, ha_discovery):
+    config = "global:\n  loglevel: WARNING\n  ha_discovery: {}\n".format(str(ha_discovery).lower())
+    config += "mqtt_client:\n  hostname: localhost\ndevices:\n"
+    for i in range(count):
+        config += "  '{:012x}':\n    name: dev{}\n    preset: F2400-B\n".format(0x7c2c00000000+i, i)
+    with tempfile.NamedTemporaryFile('w', suffix='.yaml', delete=False) as f:
+        f.write(config)
+    try:
+        return lesyd.LeSyd(['-c', f.name])
+    finally:
+        os.unlink(f.name)
+
+def bench(count, ha_discovery):
+    main = make_lesyd(count, ha_discovery)
+    client = CountingClient()
+    main.mqtt_client = client
+    main.mqtt_sydpower = client
+
+    start = time.perf_counter()
+    main.on_connect(client, None, None, ReasonCode(), None)
+    ready = time.perf_counter() - start
+
+    # Dispatch of a command that does not produce any request.
+    dev = main.devices[0]
+    dev.shadow['ac_mode'] = 'auto'
+    msg = Message(dev.topic_command+'ac_booking_charging', b'10')
+    n = 100000
+    start = time.perf_counter()
+    for i in range(n):
+        main.on_message(client, None, msg)
+    dispatch = (time.perf_counter() - start) / n
+
+    print("%6d devices: %4d subscriptions (legacy %6d)  ready in %8.3f ms  dispatch %6.2f us/msg" %
+          (count, client.subscriptions, count*LEGACY_SUBSCRIPTIONS_PER_DEVICE, ready*1e3, dispatch*1e6))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--devices', default='1,10,50,100')
+    parser.add_argument('--ha-discovery', action='store_true')
+    args = parser.parse_args()
+    for count in args.devices.split(','):
+        bench(int(count), args.ha_discovery)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/python3
+#
+# Measure the speed of the replay of a capture file (see '--replay').
+#
+# A capture is first recorded by LeSyd driving simulated stations (see
+# lesyd_sim.py) on the in-memory broker with a ManualClock, so recording
+# 'duration' simulated seconds is fast. The capture is then replayed by
+# 'lesyd.py --replay' in its own process and the number of frames per
+# second is reported.
+#
+# Usage: python3 bench/bench_replay.py [--devices 100] [--duration 600] [--keep capture.bin]
+#
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import subprocess
+
+TOP = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, TOP)
+
+import lesyd
+import lesyd_sim
+
+BROKER = 'bench'
+
+def write_config(macs, input_refresh, capture=None):
+    config = "global:\n  loglevel: WARNING\n"
+    if capture:
+        config += "  capture: '{}'\n".format(capture)
+    config += "mqtt_client:\n  transport: memory\n  hostname: {}\ndevices:\n".format(BROKER)
+    for i, mac in enumerate(macs):
+        config += "  '{}':\n    name: sim{}\n    preset: F2400-B\n".format(mac, i)
+        if input_refresh:
+            config += "    input_refresh: {}\n".format(input_refresh)
+    with tempfile.NamedTemporaryFile('w', suffix='.yaml', delete=False) as f:
+        f.write(config)
+    return f.name
+
+# Record 'duration' simulated seconds of traffic in 'capture'.
+def record(macs, capture, duration, input_refresh):
+    clock = lesyd.ManualClock(time.time())
+    config = write_config(macs, input_refresh, capture)
+    try:
+        main = lesyd.LeSyd(['-c', config], clock=clock)
+    finally:
+        os.unlink(config)
+
+    simulator = lesyd_sim.Simulator(macs)
+    client = lesyd.memory_broker(BROKER).client()
+    def on_message(client, userdata, msg):
+        result = simulator.process_request(msg.topic, msg.payload, clock())
+        if result:
+            client.publish(result[1], result[2])
+    client.on_message = on_message
+    client.reconnect()
+    client.subscribe('+/client/request/data')
+
+    main.start()
+    main.run_until(clock() + duration)
+    main.capture.close()
+    return main.capture.records
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--devices', type=int, default=100)
+    parser.add_argument('--duration', type=float, default=600, help="simulated seconds")
+    parser.add_argument('--input-refresh', type=int, default=3)
+    parser.add_argument('--keep', default=None, help="keep the capture in that file")
+    args = parser.parse_args()
+
+    macs = lesyd_sim.make_macs('7c2c00000000', args.devices)
+    capture = args.keep or tempfile.mktemp(suffix='.cap')
+    if os.path.exists(capture):
+        os.unlink(capture)
+    config = write_config(macs, args.input_refresh)
+    try:
+        start = time.perf_counter()
+        records = record(macs, capture, args.duration, args.input_refresh)
+        print("Recorded %d frames (%d bytes) in %.3fs" %
+              (records, os.path.getsize(capture), time.perf_counter() - start))
+        command = [ sys.executable, os.path.join(TOP, 'lesyd.py'), '-c', config, '--replay', capture ]
+        subprocess.run(command, check=True)
+    finally:
+        os.unlink(config)
+        if not args.keep and os.path.exists(capture):
+            os.unlink(capture)
+
+if __name__ == "__main__":
+    main()
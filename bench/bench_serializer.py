@@ -0,0 +1,72 @@
+#!/usr/bin/python3
+#
+# Compare the cost of json.dumps(state, sort_keys=True) with the cached
+# StateSerializer when a single field is modified between two publications.
+#
+# Usage: python3 bench/bench_serializer.py [--count N]
+#
+
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import lesyd
+
+STATE = {
+    'ac_booking_charging': 0,
+    'ac_charging_level': 500,
+    'ac_charging_power': 0,
+    'ac_charging_rate': 2,
+    'ac_charging_upper_limit': 100.0,
+    'ac_output': True,
+    'ac_output_power': 123,
+    'ac_silent_charging': False,
+    'charging_power': 0,
+    'dc_charging_power': 0,
+    'dc_max_charging_current': 20,
+    'dc_output': False,
+    'dc_output_power': 0.0,
+    'discharge_lower_limit': 10.0,
+    'key_sound': True,
+    'led': 'off',
+    'state_of_charge': 87.5,
+    'total_input_power': 0,
+    'usb_output': True,
+    'usb_output_power': 4.2,
+}
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=50000)
+    args = parser.parse_args()
+
+    state = dict(STATE)
+    serializer = lesyd.StateSerializer(state.keys())
+    # With orjson, the text is equivalent but not always identical.
+    if json.loads(serializer.dumps(state)) != json.loads(json.dumps(state, sort_keys=True)):
+        print("ERROR: StateSerializer does not match json.dumps")
+        sys.exit(1)
+
+    start = time.perf_counter()
+    for i in range(args.count):
+        state['ac_output_power'] = i
+        json.dumps(state, sort_keys=True)
+    reference = (time.perf_counter() - start) / args.count
+
+    start = time.perf_counter()
+    for i in range(args.count):
+        state['ac_output_power'] = i
+        serializer.invalidate('ac_output_power')
+        serializer.dumps(state)
+    cached = (time.perf_counter() - start) / args.count
+
+    print("json.dumps       %8.2f us/publication" % (reference*1e6))
+    print("StateSerializer  %8.2f us/publication  (value encoder: %s)" %
+          (cached*1e6, lesyd.JSON_BACKEND))
+
+if __name__ == "__main__":
+    main()
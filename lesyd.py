@@ -6,7 +6,6 @@ import sys
 import paho.mqtt.client as mqtt
 import argparse
 import time
-import queue
 import signal
 import json
 import yaml
@@ -14,12 +13,35 @@ import yamale
 import logging
 import logging.config as LoggingConfig
 import threading
+import struct
+import functools
+import heapq
+import itertools
+import collections
+import socket
+import selectors
+import asyncio
+import subprocess
+import zlib
+import math
+import mmap
+import sqlite3
 
 LESYD_VERSION = "0.9"
 
 DEFAULT_STATE_REFRESH=30
 DEFAULT_INPUT_REFRESH=6
 DEFAULT_HOLDING_REFRESH=30
+DEFAULT_MIN_REFRESH=2
+DEFAULT_MAX_REFRESH=30
+
+# Default publication filters of the power fields (see option 'deadbands').
+# Those values usually jitter by 1W or 0.1W at each poll.
+POWER_DEADBANDS = {
+    'ac_output_power':  { 'absolute': 1 },
+    'usb_output_power': { 'absolute': 0.5 },
+    'dc_output_power':  { 'absolute': 0.5 },
+}
 
 PRESETS = {
     'F2400-B': {
@@ -28,6 +50,8 @@ PRESETS = {
         'ac_charging_levels': [ 300, 500, 700, 900, 1100 ],
         'extension1': False,
         'extension2': False,
+        'register_map': 'sydpower',
+        'deadbands': POWER_DEADBANDS,
     }, 
     'F3600Pro': {
         'manufacturer':'Fossibot',
@@ -35,6 +59,8 @@ PRESETS = {
         'ac_charging_levels': [ 400, 800, 1200, 1600, 2200 ],
         'extension1': True,
         'extension2': True,
+        'register_map': 'sydpower',
+        'deadbands': POWER_DEADBANDS,
     }
 }
 
@@ -65,9 +91,28 @@ DeviceInfo:
    state_refresh:   int(min=3,max=60,required=False)
    input_refresh:   int(min=3,max=60,required=False)
    holding_refresh: int(min=3,max=60,required=False)
+   adaptive_refresh: bool(required=False)
+   min_refresh:     int(min=1,max=60,required=False)
+   max_refresh:     int(min=3,max=600,required=False)
+   field_topics:    bool(required=False)
+   binary_state:    enum('msgpack','cbor',required=False)
+   raw_registers:   bool(required=False)
+   worker:          int(min=0,required=False)
+   deadbands:       map(include('Deadband'), key=str(), required=False)
    ac_charging_levels: list(include('PowerLevel'),min=1,required=False)
    guess_ac_input_power: bool(required=False)
    ac_manager:      bool(required=False)
+   register_map:    str(required=False)
+   register_groups: any(str(), list(include('RegisterGroup'), min=1), required=False)
+Deadband:
+   absolute:        num(min=0,required=False)
+   relative:        num(min=0,max=1,required=False)
+   min_interval:    num(min=0,max=3600,required=False)
+RegisterGroup:
+   name:      regex('^[0-9a-zA-Z_]+$')
+   type:      enum('input','holding')
+   registers: list(any(int(min=0), regex('^[0-9]+(-[0-9]+)?$'), enum('others')), min=1)
+   refresh:   any(int(min=1,max=3600), enum('input_refresh','holding_refresh'))
 Tls:
    ca_certs: str(required=False)
    certfile: str(required=False)
@@ -78,7 +123,7 @@ Tls:
    insecure: bool(required=False)
 
 MqttInfo:
-   transport: enum('unix','tcp','websocket',required=False)
+   transport: enum('unix','tcp','websocket','memory',required=False)
    hostname:  str(required=False)
    port:      int(min=0,max=65535,required=False)
    username:  str(required=False)
@@ -94,6 +139,11 @@ Global:
    loglevel:     include('LogLevel',required=False)   
    ha_discovery: bool(required=False)
    ha_prefix:    str(required=False)
+   workers:      int(min=0,required=False)
+   capture:      str(required=False)
+   history:      str(required=False)
+   history_raw_hours:   int(min=1,required=False)
+   history_minute_days: int(min=1,required=False)
 
 
 """)
@@ -145,6 +195,21 @@ devices:
        name: foobar
 
 '''
+,
+'''
+mqtt_client:
+    hostname: 'localhost'
+devices:
+    # A preset with deadbands for fields removed by 'exclude'
+    'abcdefabcdef':
+       name: 'my_f2400'
+       preset: 'F2400-B'
+       exclude: [ usb_output_power, dc_output_power ]
+       ac_charging_levels: [ 300, 500 ]
+       register_map: 'sydpower'
+       deadbands:
+          ac_output_power: { absolute: 5, min_interval: 10 }
+'''
 ]
 
 DEFAULT_LOGGING_INI = '''
@@ -227,6 +292,331 @@ HREG_AC_BOOKING_CHARGING = 63
 HREG_DISCHARGE_LOWER_LIMIT = 66
 HREG_AC_CHARGING_UPPER_LIMIT = 67
 
+#
+# Modbus CRC16 and frame encoding.
+#
+# The CRC is computed for every request sent to a device and for every
+# response received from a device (typically 165 bytes for a full register
+# dump) so it is worth a 256 entries lookup table instead of a bit by bit
+# computation.
+#
+# If the 'crcmod' package is installed (with its C extension) then it is
+# used instead of the table.
+#
+# Reminder: The Sydpower devices expect the CRC high byte first.
+#
+
+MODBUS_CRC16_POLY = 0xA001
+
+def make_crc16_table(poly:int) -> tuple:
+    table = []
+    for byte in range(256):
+        crc = byte
+        for bit in range(8):
+            if crc & 0x0001:
+                crc = (crc >> 1) ^ poly
+            else:
+                crc >>= 1
+        table.append(crc)
+    return tuple(table)
+
+MODBUS_CRC16_TABLE = make_crc16_table(MODBUS_CRC16_POLY)
+
+def modbus_crc16_table(buf: bytes|bytearray, size:int) -> int:
+    table = MODBUS_CRC16_TABLE
+    crc = 0xFFFF
+    for byte in buf[:size]:
+        crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
+    return crc
+
+try:
+    import crcmod.predefined
+    # The pure python implementation of crcmod is not faster than ours
+    if not getattr(crcmod.crcmod, '_usingExtension', False):
+        raise ImportError("crcmod C extension is not available")
+    _crc16_native = crcmod.predefined.mkPredefinedCrcFun('modbus')
+
+    def modbus_crc16_native(buf: bytes|bytearray, size:int) -> int:
+        return _crc16_native(bytes(buf[:size]))
+
+    modbus_crc16 = modbus_crc16_native
+except ImportError:
+    modbus_crc16_native = None
+    modbus_crc16 = modbus_crc16_table
+
+MODBUS_FRAME = struct.Struct('>BBHH')
+
+# Encode a 8 bytes modbus request (channel, function, 2 words and the CRC).
+#
+# There is only a small number of distinct requests (the periodic reads and
+# the writes of a few registers with a few values) so the frames are cached.
+@functools.lru_cache(maxsize=1024)
+def encode_modbus_request(channel:int, func:int, arg1:int, arg2:int) -> bytes:
+    frame = MODBUS_FRAME.pack(channel, func, arg1, arg2)
+    return frame + modbus_crc16(frame, len(frame)).to_bytes(2, 'big')
+
+LED_CHOICES = ['off', "on", "sos", "flash"]
+
+#
+# Declarative description of the register maps.
+#
+# A RegisterField describes how a state field is computed from one or
+# more registers:
+#
+#   - regs    : a register index or a list of register indices.
+#   - combine : an optional function called with the values of 'regs'.
+#               The default is to sum the values.
+#   - mask    : an optional bit mask applied to the combined value.
+#   - divisor : an optional divisor (e.g. 10.0 for values in tenths). 
+#   - convert : an optional conversion function (e.g. bool). 
+#   - choices : an optional list of values indexed by the result.
+#
+# A list of RegisterField is compiled once into a RegisterDecoder that
+# unpacks all registers with a single struct call and then applies a
+# flat list of extractor functions.
+#
+class RegisterField():
+
+    def __init__(self, field, regs, combine=None, mask=None, divisor=None, convert=None, choices=None):
+        self.field   = field
+        self.regs    = (regs,) if type(regs) is int else tuple(regs)
+        self.combine = combine
+        self.mask    = mask
+        self.divisor = divisor
+        self.convert = convert
+        self.choices = choices
+
+    def __repr__(self):
+        return "RegisterField({!r}, {!r})".format(self.field, self.regs)
+        
+    # Return a function that computes the field value from the tuple
+    # of all register values.
+    def compile(self):
+        regs = self.regs
+        if self.combine:
+            combine = self.combine
+            get = lambda words: combine( *[ words[r] for r in regs ] )
+        elif len(regs) == 1:
+            reg = regs[0]
+            get = lambda words: words[reg]
+        else:
+            get = lambda words: sum( [ words[r] for r in regs ] )
+
+        if self.mask is not None:
+            mask = self.mask
+            get = (lambda f: lambda words: f(words) & mask)(get)
+        if self.divisor is not None:
+            divisor = self.divisor
+            get = (lambda f: lambda words: f(words) / divisor)(get)
+        if self.convert is not None:
+            convert = self.convert
+            get = (lambda f: lambda words: convert(f(words)))(get)
+        if self.choices is not None:
+            choices = self.choices
+            get = (lambda f: lambda words: choices[f(words)])(get)
+        return get
+
+# The last known values of the registers of a device.
+class RegisterImage():
+
+    def __init__(self, count:int):
+        self.values  = [0] * count
+        self.known   = 0   # bit mask of the registers received at least once
+        self.updates = 0   # incremented each time registers are received
+        self.struct  = struct.Struct('>{}H'.format(count))
+
+    def complete(self) -> bool:
+        return self.known == (1 << len(self.values)) - 1
+
+    # All registers as a sequence of big-endian 16 bit words
+    def pack(self) -> bytes:
+        return self.struct.pack(*self.values)
+
+class RegisterDecoder():
+
+    def __init__(self, fields, count:int):
+        self.fields     = tuple(fields)
+        self.count      = count
+        self.struct     = struct.Struct('>{}H'.format(count))
+        self.extractors = [ (f.field, f.compile()) for f in self.fields ]
+        self.masks      = [ sum( 1<<r for r in f.regs ) for f in self.fields ]
+        self.structs    = { count: self.struct }   
+        self.ranges     = {}   
+        
+    # Decode the registers found at 'offset' in the payload and return
+    # a list of (field,value) 
+    def decode(self, payload: bytes|bytearray, offset:int=0) -> list :
+        words = self.struct.unpack_from(payload, offset)
+        return [ (field, get(words)) for field, get in self.extractors ]
+
+    # The extractors (and register masks) of the fields using at least
+    # one of the registers first to first+count-1 
+    def range_extractors(self, first:int, count:int) -> list:
+        extractors = self.ranges.get( (first,count) )
+        if extractors is None:
+            range_mask = ((1<<count)-1) << first
+            extractors = [ (field, get, mask)
+                           for (field, get), mask in zip(self.extractors, self.masks)
+                           if mask & range_mask ] 
+            self.ranges[ (first,count) ] = extractors
+        return extractors
+
+    # Decode 'count' registers starting at register 'first' and store them
+    # in the RegisterImage 'image'. Return the fields using those registers 
+    # (but only if all their registers are known). 
+    def decode_range(self, payload: bytes|bytearray, offset:int, first:int, count:int, image:RegisterImage) -> list:
+        if count < 1 or first+count > self.count:
+            raise Exception("bad register range")
+        st = self.structs.get(count)
+        if st is None:
+            st = self.structs[count] = struct.Struct('>{}H'.format(count))
+        values = image.values
+        values[first:first+count] = st.unpack_from(payload, offset)
+        image.known |= ((1<<count)-1) << first
+        image.updates += 1
+        missing = ~image.known
+        return [ (field, get(values)) for field, get, mask in self.range_extractors(first, count)
+                 if not (mask & missing) ]
+
+# Compile a tuple of RegisterField (so at most once per register map) 
+@functools.lru_cache(maxsize=None)
+def compile_register_map(fields: tuple, count:int) -> RegisterDecoder:
+    return RegisterDecoder(fields, count)
+
+INPUT_REGISTER_MAP = [
+    RegisterField( 'state_of_charge', IREG_STATE_OF_CHARGE, divisor=10.0 ),
+    RegisterField( 'ac_output',  IREG_STATUS_BITS, mask=1<<11, convert=bool ),
+    RegisterField( 'dc_output',  IREG_STATUS_BITS, mask=1<<10, convert=bool ),
+    RegisterField( 'usb_output', IREG_STATUS_BITS, mask=1<<9,  convert=bool ),
+    RegisterField( 'total_input_power', IREG_TOTAL_INPUT_POWER ),
+    RegisterField( 'charging_power', [ IREG_AC_CHARGING_POWER, IREG_DC_CHARGING_POWER ] ),
+    RegisterField( 'ac_charging_power', IREG_AC_CHARGING_POWER ),
+    RegisterField( 'dc_charging_power', IREG_DC_CHARGING_POWER ),
+    # There is no register for the ac_input_power but we can infer it
+    # from the total_input_power (so AC+DC) and dc_charging_power
+    # HOW ACCURATE IS THAT? 
+    # Only used when 'guess_ac_input_power' is set.
+    RegisterField( 'ac_input_power', [ IREG_TOTAL_INPUT_POWER, IREG_DC_CHARGING_POWER ],
+                   combine=lambda total, dc: max(0, total-dc) ),
+    RegisterField( 'ac_output_power', IREG_AC_OUTPUT_POWER ),
+    RegisterField( 'ac_booking_charging', IREG_AC_BOOKING_CHARGING ),
+    RegisterField( 'ac_charging_rate', IREG_AC_CHARGING_RATE ),
+    RegisterField( 'usb_output_power', [ IREG_USB_OUTPUT_POWER_1,
+                                         IREG_USB_OUTPUT_POWER_2,
+                                         IREG_USB_OUTPUT_POWER_3,
+                                         IREG_USB_OUTPUT_POWER_4,
+                                         IREG_USB_OUTPUT_POWER_5,
+                                         IREG_USB_OUTPUT_POWER_6 ], divisor=10.0 ),
+    RegisterField( 'dc_output_power', [ IREG_LED_POWER, IREG_DC_OUTPUT_POWER_1 ], divisor=10.0 ),
+    RegisterField( 'led', IREG_LED_STATE, mask=0x3, choices=LED_CHOICES ),
+]
+
+# Most holding registers are redundant with an input register
+# but it is better to update the state as soon as possible.
+HOLDING_REGISTER_MAP = [
+    RegisterField( 'ac_silent_charging', HREG_AC_SILENT_CHARGING, convert=bool ),
+    RegisterField( 'ac_output',  HREG_AC_OUTPUT,  convert=bool ),
+    RegisterField( 'dc_output',  HREG_DC_OUTPUT,  convert=bool ),
+    RegisterField( 'usb_output', HREG_USB_OUTPUT, convert=bool ),
+    RegisterField( 'dc_max_charging_current', HREG_DC_MAX_CHARGING_CURRENT ),
+    RegisterField( 'ac_booking_charging', HREG_AC_BOOKING_CHARGING ),
+    RegisterField( 'key_sound', HREG_KEY_SOUND, convert=bool ),
+    RegisterField( 'ac_charging_rate', HREG_AC_CHARGING_RATE ),
+    RegisterField( 'discharge_lower_limit',   HREG_DISCHARGE_LOWER_LIMIT,   divisor=10.0 ),
+    RegisterField( 'ac_charging_upper_limit', HREG_AC_CHARGING_UPPER_LIMIT, divisor=10.0 ),
+]
+
+# The register maps that can be selected with the 'register_map' option.
+# All known devices are currently using the same registers.
+REGISTER_MAPS = {
+    'sydpower': {
+        'input':   INPUT_REGISTER_MAP,
+        'holding': HOLDING_REGISTER_MAP,
+    },
+}
+
+#
+# Register groups.
+#
+# The registers are polled by groups. Each group has its own refresh
+# interval that is either a number of seconds or the name of a device
+# option ('input_refresh' or 'holding_refresh').
+#
+# The registers of a group are given as a list of register numbers,
+# ranges such as '18-22' or 'others' for all registers that are not in
+# another group of the same type.
+#
+# The named sets of groups can be selected with the 'register_groups'
+# option. Explicit groups can also be given in the configuration file.
+#
+REGISTER_GROUPS = {
+    # Read all registers at once (the default)
+    'full': [
+        { 'name': 'input',   'type': 'input',   'registers': [ '0-79' ], 'refresh': 'input_refresh' },
+        { 'name': 'holding', 'type': 'holding', 'registers': [ '0-79' ], 'refresh': 'holding_refresh' },
+    ],
+    # Read the power, state of charge and status registers more often. 
+    'fast_slow': [
+        { 'name': 'fast',    'type': 'input',   'registers': [ '2-6', 9, 15, '18-22', '30-37', 41, '53-59' ], 'refresh': 'input_refresh' },
+        { 'name': 'slow',    'type': 'input',   'registers': [ 'others' ], 'refresh': 'holding_refresh' },
+        { 'name': 'holding', 'type': 'holding', 'registers': [ '0-79' ], 'refresh': 'holding_refresh' },
+    ],
+}
+
+# Reading a few unneeded registers is cheaper than an additional request
+# (8 bytes, a response header and a device round-trip).
+READ_PLANNER_MAX_GAP = 8
+
+# Merge a set of registers into a minimal list of (first,count) ranges.
+# Registers separated by at most max_gap unneeded registers are read together
+# unless one of those registers is in 'exclude' (e.g. the registers already
+# read by another group at a different rate).
+def plan_register_reads(registers, max_gap:int=READ_PLANNER_MAX_GAP, exclude=frozenset()) -> list:
+    ranges = []
+    for reg in sorted(set(registers)):
+        end = ranges[-1][0]+ranges[-1][1] if ranges else None
+        if ranges and reg - end <= max_gap and exclude.isdisjoint(range(end, reg)):
+            first = ranges[-1][0] 
+            ranges[-1] = (first, reg-first+1)
+        else:
+            ranges.append( (reg,1) )
+    return ranges
+
+# Convert a list of register specifications (see REGISTER_GROUPS) into a set of
+# registers. 'others' is returned as None.
+def parse_register_list(specs, count:int):
+    registers = set()
+    for spec in specs:
+        if spec == 'others':
+            return None
+        if type(spec) is int:
+            first = last = spec
+        else:
+            a, sep, b = str(spec).partition('-')
+            first = int(a)
+            last  = int(b) if sep else first
+        if not (0 <= first <= last < count):
+            raise ValueError("bad register range '{}'".format(spec))
+        registers.update(range(first, last+1))
+    return registers
+
+# A periodic read of a range of registers.
+#
+# When 'adjustable' is set (i.e. for the groups using 'input_refresh'), the
+# interval can be modified by the adaptive polling and by the burst mode.
+class PollRequest():
+
+    def __init__(self, group:str, payload:bytes, refresh:float, adjustable:bool=False):
+        self.group      = group
+        self.payload    = payload
+        self.refresh    = refresh   # the configured interval
+        self.interval   = refresh   # the current interval 
+        self.adjustable = adjustable
+        self.last       = 0.0       # when the registers were read for the last time.
+
+    def due(self) -> float:
+        return self.last + self.interval
+
 def homeassistant_discovery_bridge(lesyd, mqtt_client):
 
     # TODO !!!!    
@@ -306,7 +696,10 @@ def identifier_to_text(ident):
     text = text.replace(" Ups "," UPS ")
     return text[1:-1]
 
-def homeassistant_select_discovery(lesyd, field, choices):
+# 'value' is the jinja expression of the field value in the state payload.
+def homeassistant_select_discovery(lesyd, field, choices, value=None):
+
+    value = value or "value_json."+field
 
     # trans will contain the translations we need to perform
     trans={}
@@ -318,13 +711,13 @@ def homeassistant_select_discovery(lesyd, field, choices):
         # we want to generate something like that
         #  - for 'value_template' 
         #      {% set trans={'key1':'value1','key2':'value2'} %}
-        #      {{ trans[value_json.field] | default(value_json.field) }}
+        #      {{ trans[value] | default(value) }}  with value=value_json.field
         #  - for 'command_template'
         #      {% set trans={'value1':'key1','value2':'key2'} %}
         #      {{ trans[value] | default(value) }}
         #
         value_template  = jinja_set_dict('trans',trans)
-        value_template += "{{ trans[value_json."+field+"] | default(value_json."+field+") }}"
+        value_template += "{{ trans["+value+"] | default("+value+") }}"
         command_template  = jinja_set_dict_rev('trans',trans)
         command_template += "{{ trans[value] | default(value) }} "
         return {
@@ -335,7 +728,7 @@ def homeassistant_select_discovery(lesyd, field, choices):
     else: # No translation needed. 
         return {
             "options": choices,
-            "value_template": "{{ value_json.{} }}".format(field),
+            "value_template": "{{ "+value+" }}",
         }
                 
 def homeassistant_discovery_device(lesyd, device, mqtt_client):
@@ -372,6 +765,10 @@ def homeassistant_discovery_device(lesyd, device, mqtt_client):
 
     # "entity_category": "diagnostic",
     # "entity_category": "config",
+
+    # With 'field_topics', each entity uses the topic of its own field.
+    def field_value(key):
+        return "value_json" if device.field_topics else "value_json."+key
             
     components = {
         ##### DO NOT REMOVE: Obsolete entities are provided with their platform.
@@ -441,11 +838,13 @@ def homeassistant_discovery_device(lesyd, device, mqtt_client):
         ##### Select #####
         "led":{
             "platform": "select",
-            ** homeassistant_select_discovery(lesyd, 'led', device.LED_CHOICES),
+            ** homeassistant_select_discovery(lesyd, 'led', device.LED_CHOICES,
+                                              field_value('led')),
         },
         "ac_mode":{
             "platform": "select",
-            ** homeassistant_select_discovery(lesyd, 'ac_mode', device.AC_MODE_CHOICES),
+            ** homeassistant_select_discovery(lesyd, 'ac_mode', device.AC_MODE_CHOICES,
+                                              field_value('ac_mode')),
         },
         ##### Number #####
         "ac_booking_charging": {
@@ -528,11 +927,14 @@ def homeassistant_discovery_device(lesyd, device, mqtt_client):
                 entry["name"] = identifier_to_text(key)
             
             if "value_template" not in entry:
-                entry["value_template"] = "{{ value_json."+key+" }}"
+                entry["value_template"] = "{{ "+field_value(key)+" }}"
+
+            if device.field_topics:
+                entry["state_topic"] = device.topic_field + key
 
             if "command_topic" not in entry:
                 if platform in ["switch","number","select"] :
-                    entry["command_topic"] = device.topic_state + "/set/" + key
+                    entry["command_topic"] = device.topic_command + key
                     
             discovery['components'][key] = entry 
             
@@ -548,11 +950,307 @@ def homeassistant_discovery_device(lesyd, device, mqtt_client):
     payload = json.dumps(discovery, sort_keys=True)
     mqtt_client.publish(topic, payload, retain=True)
     
-class Request():
+#
+# A simple deadline scheduler based on a heap.
+#
+# Each deadline is identified by a key (e.g. a Device). Scheduling a key
+# again replaces its previous deadline. The main loop only needs to sleep
+# until next_deadline().
+#
+class Scheduler():
+
+    def __init__(self):
+        self.heap    = []    # entries [when, seq, key, callback] 
+        self.entries = {}    # key -> entry in heap
+        self.seq     = itertools.count()
+        self.cancelled = 0   # number of cancelled entries still in heap
+
+    def __len__(self):
+        return len(self.entries)
+
+    def schedule(self, key, when, callback):
+        self.cancel(key)
+        if when is None:
+            return
+        entry = [when, next(self.seq), key, callback]
+        self.entries[key] = entry
+        heapq.heappush(self.heap, entry)
+
+    def cancel(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            entry[3] = None
+            self.cancelled += 1
+            # Do not let the heap grow with cancelled entries.
+            if self.cancelled > 64 and self.cancelled > len(self.heap)//2:
+                self.heap = [ e for e in self.heap if e[3] is not None ]
+                heapq.heapify(self.heap)
+                self.cancelled = 0
+
+    # Return the time of the earliest deadline or None
+    def next_deadline(self):
+        heap = self.heap
+        while heap and heap[0][3] is None:
+            heapq.heappop(heap)
+            self.cancelled -= 1
+        return heap[0][0] if heap else None
+
+    # Return the delay until the earliest deadline (or None if there is none)
+    def timeout(self, now):
+        when = self.next_deadline()
+        if when is None:
+            return None
+        return max(0.0, when-now)
+
+    # Call the callbacks of all deadlines that are due.
+    # Deadlines scheduled by those callbacks will be processed by the next call.
+    def run_due(self, now):
+        heap = self.heap
+        due = []
+        while heap and heap[0][0] <= now:
+            entry = heapq.heappop(heap)
+            if entry[3] is None:
+                self.cancelled -= 1
+                continue
+            del self.entries[entry[2]]
+            due.append(entry[3])
+        for callback in due:
+            callback()
+
+# Serialize a state dictionary with a fixed set of keys into the same JSON
+# text as json.dumps(state, sort_keys=True).
+#
+# The sorted keys are encoded once and the encoded values are cached until
+# they are invalidated (i.e. when the field is modified). If the 'orjson'
+# package is installed then it is used to encode the modified values and
+# the text can differ: non-ASCII characters are written as UTF-8
+# instead of \uXXXX escapes, NaN and infinities become null and a few
+# floats are written with a different exponent notation.
+#
+try:
+    import orjson
+
+    def json_value(value) -> str:
+        return orjson.dumps(value).decode()
+    JSON_BACKEND = 'orjson'
+except ImportError:
+    json_value = json.dumps
+    JSON_BACKEND = 'json'
+
+class StateSerializer():
+
+    def __init__(self, keys):
+        self.keys      = sorted(keys)
+        self.prefixes  = { key: json.dumps(key)+': ' for key in self.keys }
+        self.values    = {}   # key -> encoded value 
+        self.fragments = {}   # key -> encoded '"key": value' 
+
+    # Must be called when the value of 'key' is modified 
+    def invalidate(self, key):
+        self.values.pop(key, None)
+        self.fragments.pop(key, None)
+
+    # The JSON text of state[key]
+    def value(self, state, key) -> str:
+        text = self.values.get(key)
+        if text is None:
+            text = self.values[key] = json_value(state[key])
+        return text
+
+    def dumps(self, state) -> str:
+        fragments = self.fragments
+        parts = []
+        for key in self.keys:
+            fragment = fragments.get(key)
+            if fragment is None:
+                fragment = fragments[key] = self.prefixes[key] + self.value(state, key)
+            parts.append(fragment)
+        return '{' + ', '.join(parts) + '}'
+
+#
+# Optional encoders of the binary state (see option 'binary_state')
+#
+BINARY_ENCODERS = {}
+try:
+    import msgpack
+    BINARY_ENCODERS['msgpack'] = msgpack.packb
+except ImportError:
+    pass
+try:
+    import cbor2
+    BINARY_ENCODERS['cbor'] = cbor2.dumps
+except ImportError:
     pass
 
+# A publication filter for a numerical state field.
+#
+# A modification is ignored if the difference with the last published value
+# is not larger than 'absolute' or than 'relative' times the last published
+# value. A modification accepted less than 'min_interval' seconds after the
+# last publication is delayed.
+class FieldFilter():
+
+    def __init__(self, absolute=None, relative=None, min_interval=None):
+        self.absolute     = absolute
+        self.relative     = relative
+        self.min_interval = min_interval or 0
+        self.value        = None   # the last published value
+        self.time         = 0.0    # when it was published
+        self.suppressed   = 0      # the number of ignored modifications 
+
+    def accept(self, value) -> bool:
+        last = self.value
+        if last is None or type(value) is bool or not isinstance(value, (int,float)):
+            return True
+        diff = abs(value - last)
+        if self.absolute is not None and diff <= self.absolute:
+            return False
+        if self.relative is not None and diff <= self.relative * abs(last):
+            return False
+        return True
+
+    # The earliest time at which a modification can be published.
+    def earliest(self) -> float:
+        return self.time + self.min_interval
+
+    def published(self, value, now):
+        self.value = value
+        self.time  = now
+
+# A request sent to a device.
+#
+# The device responses start with the function code followed by the first
+# register (read) or the written register (write) so they can be matched
+# with the request.
+class Request():
+
+    def __init__(self, payload: bytes, now: float):
+        self.payload   = payload
+        self.func      = payload[1]
+        self.reg       = (payload[2]<<8) | payload[3]
+        self.sent_time = now
+
+    def matches(self, func:int, reg:int) -> bool:
+        if func & 0x80:
+            # An error response only provides the function code.
+            return (func & 0x7F) == self.func 
+        return func == self.func and reg == self.reg
+
 class WriteRequest(Request):
     pass
+
+# The queue of the requests waiting to be sent to a device.
+#
+# Pending requests are keyed so that
+#   - a write to a register replaces a pending write to the same register
+#     (e.g. while dragging a slider in Home Assistant only the latest
+#     value is written).
+#   - identical read requests are only sent once.
+#
+# A replaced request keeps its position in the queue.
+#
+# The methods are named as in queue.Queue but the queue is only used from
+# the main thread so there is no locking.
+class RequestQueue():
+
+    def __init__(self):
+        self.pending    = collections.OrderedDict()   # key -> payload
+        self.queued     = 0  # number of requests added to the queue  
+        self.coalesced  = 0  # number of writes replaced by a newer value
+        self.duplicates = 0  # number of requests dropped because already queued
+
+    def key(self, payload: bytes):
+        if payload[1] == Device.FUNC_WRITE_HOLDING_REGISTER:
+            return payload[1:4]   # function and register
+        return payload[1:6]       # function, first register and count 
+
+    def put(self, payload: bytes):
+        key = self.key(payload)
+        old = self.pending.get(key)
+        if old is None:
+            self.queued += 1
+        elif old == payload:
+            self.duplicates += 1
+            return
+        else:
+            self.coalesced += 1
+        self.pending[key] = payload
+
+    def get(self, block=False) -> bytes:
+        return self.pending.popitem(last=False)[1]
+
+    def empty(self) -> bool:
+        return not self.pending
+
+    def qsize(self) -> int:
+        return len(self.pending)
+
+# Track the request in flight for a device.
+#
+# The device can only process one request at a time so a new request is
+# sent as soon as the response to the previous one is received. 
+#
+# The round-trip times are measured in order to derive the timeout after
+# which we stop waiting for a response (in the same way as TCP, see RFC 6298). 
+class RequestEngine():
+
+    INITIAL_TIMEOUT = 0.3
+    MIN_TIMEOUT     = 0.1
+    MAX_TIMEOUT     = 2.0
+
+    def __init__(self):
+        self.current  = None   # The Request awaiting a response
+        self.srtt     = None   # smoothed round-trip time
+        self.rttvar   = None   # round-trip time variation
+        self.timeout  = self.INITIAL_TIMEOUT
+        self.sent      = 0
+        self.completed = 0
+        self.timeouts  = 0
+
+    def busy(self) -> bool:
+        return self.current is not None
+
+    # When we stop waiting for the current request
+    def deadline(self):
+        if self.current is None:
+            return None
+        return self.current.sent_time + self.timeout
+
+    def start(self, payload: bytes, now: float) -> Request:
+        if payload[1] == Device.FUNC_WRITE_HOLDING_REGISTER:
+            self.current = WriteRequest(payload, now)
+        else:
+            self.current = Request(payload, now)
+        self.sent += 1
+        return self.current
+
+    # Called for each response. Return the completed Request or None if
+    # the response does not match the current request.
+    def complete(self, func:int, reg:int, now:float):
+        request = self.current
+        if request is None or not request.matches(func, reg):
+            return None
+        self.current = None
+        self.completed += 1
+        rtt = max(0.0, now - request.sent_time)
+        if self.srtt is None:
+            self.srtt   = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75*self.rttvar + 0.25*abs(self.srtt-rtt)
+            self.srtt   = 0.875*self.srtt + 0.125*rtt
+        self.timeout = min(self.MAX_TIMEOUT, max(self.MIN_TIMEOUT, self.srtt + 4*self.rttvar))
+        return request
+
+    # Stop waiting for the current request if its timeout expired.
+    def expire(self, now:float) -> bool:
+        if self.current is None or now < self.current.sent_time + self.timeout:
+            return False
+        self.current = None
+        self.timeouts += 1
+        # The device or the broker may be slower than expected.
+        self.timeout = min(self.MAX_TIMEOUT, self.timeout*2)
+        return True
     
 class Device():
 
@@ -562,7 +1260,7 @@ class Device():
     FUNC_READ_INPUT_REGISTERS=4
     FUNC_WRITE_HOLDING_REGISTER=6
 
-    LED_CHOICES=['off', "on", "sos", "flash"]
+    LED_CHOICES=LED_CHOICES
     AC_MODE_CHOICES=['manual', "standby", "low", "high"]  # and 'auto'
 
     # Up to 24 hours of MAX_AC_BOOKING_CHARGING
@@ -574,6 +1272,15 @@ class Device():
     MIN_AC_CHARGING_UPPER_LIMIT=600    # 60% 
     MAX_AC_CHARGING_UPPER_LIMIT=1000   # 100% 
 
+    # Assume that the device is offline after that delay without message
+    # (or twice the shortest poll interval if longer, see offline_delay()).
+    OFFLINE_DELAY=20
+    # Delay between two publications of an unconfirmed status
+    STATUS_REPUBLISH_DELAY=10
+
+    # Maximum duration of the burst mode in seconds
+    MAX_BURST_DURATION=3600
+
     def __init__(self, lesyd, mac, config):
 
         self.lesyd = lesyd
@@ -606,6 +1313,13 @@ class Device():
         # The topics for the LOCAL MQTT server
         self.topic_root        = lesyd.name + "/" + self.name
         self.topic_state       = self.topic_root + "/state"
+        self.topic_command     = self.topic_state + "/set/"    # + COMMAND
+        self.topic_field       = self.topic_state + "/"        # + FIELD 
+        self.topic_binary_state = self.topic_root + "/binary/state"
+        self.topic_raw_input    = self.topic_root + "/raw/input"
+        self.topic_raw_holding  = self.topic_root + "/raw/holding"
+        self.topic_history_get      = self.topic_root + "/history/get"
+        self.topic_history_response = self.topic_root + "/history/response"
         #self.topic_config       = self.topic_state + '/config'
 
         # 
@@ -617,12 +1331,9 @@ class Device():
         self.status_time = 0 # time of the last status publication
 
                         
-        self.payload_ReadAllInputRegisters   = self.encode_ReadInputRegisters(0,COUNT_IREG)
-        self.payload_ReadAllHoldingRegisters = self.encode_ReadHoldingRegisters(0,COUNT_HREG)
-
-        # When the input and holding responses where updated for the last time  
-        self.input_response_time    = 0.0
-        self.holding_response_time  = 0.0
+        # The last known values of the input and holding registers.
+        self.input_registers   = RegisterImage(COUNT_IREG)
+        self.holding_registers = RegisterImage(COUNT_HREG)
 
         # When the last message was received from the device
         self.last_device_time = 0.0
@@ -630,14 +1341,13 @@ class Device():
         # The device can only process one request at a time (because of MODBUS?)    
         # so the request payloads to mqtt_sydpower are consumed from a queue.
         # A request is simply described by its payload.
-        self.request_queue = queue.Queue()
+        self.request_queue = RequestQueue()
+
+        # The request for which we are currently awaiting a response.
+        self.requests = RequestEngine()
 
-        # The payload of the last request for which we are currenly awaiting a response.
-        self.current_request = None 
-        # and when that request was published.
-        self.current_request_time = 0   
-        # The timeout after which we stop waiting for the request.
-        self.request_timeout = 0.3
+        # Poll at 'min_refresh' until that time (see command 'burst')
+        self.burst_until = 0.0
 
         # All fields that are by default enabled in the published state.
         # The option 'exclude' can remove some of them
@@ -666,8 +1376,11 @@ class Device():
             'usb_output_power',
         ]
 
-        self.state_last_time = 0   # Time of the last state publication   
-        self.state_last = None     # Last published state   
+        self.state_last_time = 0       # Time of the last state publication   
+        self.state_published = False   # True after the first state publication
+
+        # The state fields modified since the last publication.
+        self.dirty = set()
 
         # self.state contains the fields that we are going to publish
         self.state  = { k: None for k in self.default_fields }
@@ -691,7 +1404,16 @@ class Device():
             'guess_ac_input_power': False,
             'exclude' : [],
             'ac_manager': False,
-            'ac_silent_level': 500  # TODO
+            'ac_silent_level': 500,  # TODO
+            'register_map': 'sydpower',
+            'register_groups': 'full',
+            'adaptive_refresh': False,
+            'min_refresh': DEFAULT_MIN_REFRESH,
+            'max_refresh': DEFAULT_MAX_REFRESH,
+            'field_topics': False,
+            'binary_state': None,
+            'raw_registers': False,
+            'worker': None,
         }
             
         # Apply 'preset' if specified
@@ -704,6 +1426,13 @@ class Device():
                 self.logger.warning("Unknown preset '{}'".format(preset_name))            
 
         options.update(device_options)
+
+        # The deadbands of the preset and of the device are merged.
+        deadbands = {}
+        for source in [ preset_name and PRESETS.get(preset_name) or {}, device_options ]:
+            for field, deadband in (source.get('deadbands') or {}).items():
+                deadbands.setdefault(field, {}).update(deadband or {})
+        options['deadbands'] = deadbands
         
         #################################### 
 
@@ -714,6 +1443,31 @@ class Device():
         self.state_refresh   = options['state_refresh']
         self.input_refresh   = options['input_refresh']
         self.holding_refresh = options['holding_refresh']
+        self.adaptive_refresh = options['adaptive_refresh']
+        self.min_refresh     = options['min_refresh']
+        self.max_refresh     = max(options['max_refresh'], self.min_refresh)
+        self.field_topics    = options['field_topics']
+        self.worker          = options['worker']
+
+        # Publish the raw registers when they are modified.
+        # Each entry is [topic, image, updates, payload] where 'updates' and
+        # 'payload' are those of the last publication.
+        self.raw_registers = options['raw_registers']
+        self.raw_publications = []
+        if self.raw_registers:
+            self.raw_publications = [ [ self.topic_raw_input,   self.input_registers,   0, None ],
+                                      [ self.topic_raw_holding, self.holding_registers, 0, None ] ]
+
+        # The encoder of the optional binary state
+        self.binary_state = options['binary_state']
+        self.binary_encoder = None
+        if self.binary_state:
+            self.binary_encoder = BINARY_ENCODERS.get(self.binary_state)
+            if self.binary_encoder is None:
+                self.logger.error("The python package required by binary_state '%s' is not installed",
+                                  self.binary_state)
+                sys.exit(1)
+
         self.loglevel        = options['loglevel']
         self.guess_ac_input_power = options['guess_ac_input_power']
         self.ac_manager      = options['ac_manager']
@@ -727,6 +1481,22 @@ class Device():
             del self.state['ac_input_power']
             
         self.DC_MAX_CHARGING_CURRENT = 20  # TODO: add config option 
+
+        register_map = REGISTER_MAPS.get(options['register_map'])
+        if register_map is None:
+            self.logger.error("Unknown register map '%s'", options['register_map'])
+            sys.exit(1)
+
+        input_fields = tuple( f for f in register_map['input']
+                              if f.field != 'ac_input_power' or self.guess_ac_input_power )
+        self.input_decoder   = compile_register_map(input_fields, COUNT_IREG)
+        self.holding_decoder = compile_register_map(tuple(register_map['holding']), COUNT_HREG)
+
+        # The periodic register reads.
+        self.polls = self.make_poll_requests(options)
+        # Reminder: the function, first register and count are at the same
+        # position in the requests and in the responses.
+        self.polls_by_key = { poll.payload[1:6]: poll for poll in self.polls }
         
         # Probably not needed except for debug
         self.options = options 
@@ -740,8 +1510,124 @@ class Device():
         for field in exclude:
             if field in self.state.keys():
                 del self.state[field]     
+
+        # The state fields that were never set. The state is not published
+        # until all of them are known.
+        self.unknown = { k for k, v in self.state.items() if v is None }
+
+        # The set of state fields is now fixed.
+        self.serializer = StateSerializer(self.state.keys())
+
+        # The publication filters of the state fields. The deadbands of the
+        # fields removed by the options (e.g. 'exclude') are ignored.
+        self.filters = {}
+        for field, deadband in options['deadbands'].items():
+            if field in self.state:
+                self.filters[field] = FieldFilter(**deadband)
+            elif field not in self.default_fields:
+                self.logger.warning("Deadband for unknown field '%s'", field)
+        # The filtered fields waiting for their 'min_interval': field -> deadline
+        self.deferred = {}
+        # Number of modifications that were not published because of the filters.
+        self.suppressed = 0
+
+        # When each field was recorded in the history for the last time.
+        self.history_times = {}
+
+        # The commands accepted on 'lesyd/DEVICE/state/set/COMMAND'
+        self.command_handlers = {
+            'ac_output':               self.command_ac_output,
+            'usb_output':              self.command_usb_output,
+            'dc_output':               self.command_dc_output,
+            'key_sound':               self.command_key_sound,
+            'ac_silent_charging':      self.command_ac_silent_charging,
+            'ac_booking_charging':     self.command_ac_booking_charging,
+            'dc_max_charging_current': self.command_dc_max_charging_current,
+            'led':                     self.command_led,
+            'discharge_lower_limit':   self.command_discharge_lower_limit,
+            'ac_charging_upper_limit': self.command_ac_charging_upper_limit,
+            'ac_mode':                 self.command_ac_mode,
+            'burst':                   self.command_burst,
+        }
     
                 
+    # The delay without message after which the device is assumed offline.
+    #
+    # The adaptive polling and long refresh options can make the interval
+    # between two responses longer than OFFLINE_DELAY, so allow two missed
+    # polls and the response timeout.
+    def offline_delay(self) -> float:
+        if not self.polls:
+            return self.OFFLINE_DELAY
+        interval = min(poll.interval for poll in self.polls)
+        return max(self.OFFLINE_DELAY, 2*interval + self.requests.timeout)
+
+    # Compute the next interval of a PollRequest after a response that
+    # modified 'changes' fields.
+    #
+    # With 'adaptive_refresh', the interval is halved when something changed
+    # and slowly increased when nothing changed.
+    def poll_interval(self, poll, changes, now):
+        if not poll.adjustable:
+            return poll.refresh
+        if now < self.burst_until:
+            return self.min_refresh
+        if not self.adaptive_refresh:
+            return poll.refresh
+        if changes:
+            return max(self.min_refresh, poll.interval / 2)
+        else:
+            return min(self.max_refresh, poll.interval * 1.5)
+
+    # Create the PollRequest for the 'register_groups' option. 
+    def make_poll_requests(self, options):
+
+        groups = options['register_groups']
+        if type(groups) is str:
+            if groups not in REGISTER_GROUPS:
+                self.logger.error("Unknown register groups '%s'", groups)
+                sys.exit(1)
+            groups = REGISTER_GROUPS[groups]
+
+        polls = []
+        for kind, count, encode in [ ('input',   COUNT_IREG, self.encode_ReadInputRegisters),
+                                     ('holding', COUNT_HREG, self.encode_ReadHoldingRegisters) ]:
+            used   = set()
+            others = None
+            for group in groups:
+                if group['type'] != kind:
+                    continue
+                refresh = group['refresh']
+                if type(refresh) is str:
+                    refresh = options[refresh]
+                try:
+                    registers = parse_register_list(group['registers'], count)
+                except ValueError as e:
+                    self.logger.error("Register group '%s': %s", group['name'], e)
+                    sys.exit(1)
+                adjustable = (group['refresh'] == 'input_refresh')
+                if registers is None:
+                    others = (group['name'], refresh, adjustable)
+                    continue
+                # The reads of two groups could be identical and only one of
+                # them would be recognized in the responses.
+                if not used.isdisjoint(registers):
+                    self.logger.error("Register group '%s': registers %s are already in another %s group",
+                                      group['name'], sorted(used & registers), kind)
+                    sys.exit(1)
+                used.update(registers)
+                for first, n in plan_register_reads(registers):
+                    polls.append( PollRequest(group['name'], encode(first,n), refresh, adjustable) )
+            if others:
+                # Do not read the registers of the other groups again.
+                registers = set(range(count)) - used
+                for first, n in plan_register_reads(registers, exclude=used):
+                    polls.append( PollRequest(others[0], encode(first,n), others[1], others[2]) )
+
+        for poll in polls:
+            self.logger.info("Poll group '%s': %s every %ss", poll.group, poll.payload[1:6].hex(), poll.refresh)
+        return polls
+
     # Set the current status to either 'online' or 'offline'
     def set_status(self, value): 
         if value != self.status:
@@ -751,84 +1637,175 @@ class Device():
             self.status_confirmed = False  
             self.status_time = 0
 
-    def on_tic(self, main):
+    # Request a call to process_deadline() as soon as possible.
+    #
+    # Must be called after any event that could require an immediate action
+    # from the device (e.g. a state change, a queued request, a connection).
+    def wake(self):
+        self.lesyd.scheduler.schedule(self, self.lesyd.clock(), self.process_deadline)
+
+    # Called by the scheduler when the next device deadline is reached.
+    def process_deadline(self):
 
-        now = time.time()
+        now = self.lesyd.clock()
+        lesyd = self.lesyd
 
         # Assume offline if nothing was received from the device for a long time
         # TODO: the delay should be configurable.
-        if now > self.last_device_time + 20:
+        if now >= self.last_device_time + self.offline_delay():
             self.set_status('offline')
 
-        if main.mqtt_client.is_connected() :
+        if lesyd.mqtt_client.is_connected() :
 
             # publish or re-publish the device status. 
             if not self.status_confirmed:                
-                if now > self.status_time + 10:
-                    self.lesyd.mqtt_client.publish(self.topic_status, self.status, retain=True)
+                if now >= self.status_time + self.STATUS_REPUBLISH_DELAY:
+                    lesyd.mqtt_client.publish(self.topic_status, self.status, retain=True)
                     self.status_time = now
             
+            ### The raw registers
+            for raw in self.raw_publications:
+                topic, image, updates, last_payload = raw
+                if image.updates != updates and image.complete():
+                    raw[2] = image.updates
+                    payload = image.pack()
+                    if payload != last_payload:
+                        lesyd.mqtt_client.publish(topic, payload, retain=True)
+                        raw[3] = payload
+
+            ### Filtered fields waiting for their 'min_interval'
+            if self.deferred:
+                for field, deadline in list(self.deferred.items()):
+                    if now >= deadline:
+                        del self.deferred[field]
+                        self.dirty.add(field)
+
             ### Publish the device 'state' 
-            if self.state_last is None:
+            if not self.state_published:
                 # At startup, wait for the state to be fully populated
-                do_publish = not (None in self.state.values())
-            elif self.state != self.state_last:
-                do_publish = True
-            elif now > self.state_last_time + self.state_refresh :
-                do_publish = True
-            else:
-                do_publish = False
-
-            if do_publish:
-                self.logger.debug("Publish state %s",self.state)                                
-                main.mqtt_client.publish(self.topic_state,
-                                         json.dumps(self.state,sort_keys=True))
-                self.state_last = self.state.copy()
-                self.state_last_time = now        
+                if not self.unknown:
+                    self.publish_state(now, list(self.state))
+            elif self.dirty or now >= self.state_last_time + self.state_refresh:
+                self.publish_state(now, self.dirty)
 
-        if main.mqtt_sydpower.is_connected() :
+        if lesyd.mqtt_sydpower.is_connected() :
 
             
             ### The device can only process one request at a time so
             ### send them one by one
 
-            if self.current_request:
-                if now > self.current_request_time + self.request_timeout:
-                    # We do not want to be stuck if a message was lost
-                    # so stop waiting for a response after a short delay.
-                    self.current_request = None
-                elif self.request_queue.qsize() > 10: 
-                    # Do not wait if the queue is growing too much 
-                    self.current_request = None
-
-            if self.current_request is None:
-
-                # Note: internal request ReadAllInputRegisters and ReadAllHoldingRegisters have 
-                # higher priority than the queued requests. Send the one that is
-                # the most overdue.
-
-                input_overdue   = now - (self.input_response_time   + self.input_refresh   )
-                holding_overdue = now - (self.holding_response_time + self.holding_refresh )
-
-                payload = None
-                if input_overdue >= max(0,holding_overdue):
-                    # print("request ReadAllInputRegisters")
-                    payload = self.payload_ReadAllInputRegisters
-                    self.input_response_time = now
-                elif holding_overdue >= max(0,input_overdue):
-                    # print("request ReadAllHoldingRegisters")
-                    payload = self.payload_ReadAllHoldingRegisters
-                    self.holding_response_time = now 
-                elif not self.request_queue.empty():
-                    payload = self.request_queue.get(False)
-
-                if payload:
-                    main.mqtt_sydpower.publish(self.topic_request, payload)        
-                    self.current_request      = payload
-                    self.current_request_time = time.time()                               
+            if self.requests.expire(now):
+                # We do not want to be stuck if a message was lost
+                # so stop waiting for a response after a short delay.
+                self.logger.debug("Request timeout. Next timeout is %.3fs", self.requests.timeout)
+
+            self.send_next_request(now)
 
             self.maintain_ac_mode()
 
+        lesyd.scheduler.schedule(self, self.next_deadline(now), self.process_deadline)
+
+    # Send the next request if the device is not busy.
+    def send_next_request(self, now):
+
+        if self.requests.busy():
+            return
+
+        # Note: the periodic register reads have higher priority than the
+        # queued requests. Send the one that is the most overdue.
+
+        payload = None
+        poll = None
+        for p in self.polls:
+            overdue = now - p.due()
+            if overdue >= 0 and (poll is None or overdue > poll_overdue):
+                poll = p
+                poll_overdue = overdue 
+
+        if poll:
+            payload = poll.payload
+            poll.last = now
+        elif not self.request_queue.empty():
+            payload = self.request_queue.get(False)
+            self.logger.debug("Request queue: queued=%d coalesced=%d duplicates=%d",
+                              self.request_queue.queued,
+                              self.request_queue.coalesced,
+                              self.request_queue.duplicates)
+
+        if payload:
+            self.lesyd.mqtt_sydpower.publish(self.topic_request, payload)        
+            if self.lesyd.capture:
+                self.lesyd.capture.record(CAPTURE_OUTBOUND, self.topic_request, payload, now)
+            self.requests.start(payload, now)
+
+    # Publish the state and/or the modified 'fields' 
+    #
+    # With 'field_topics', the modified fields are published on their own
+    # topic and the whole state is only published every 'state_refresh'
+    # seconds. 
+    def publish_state(self, now, fields):
+        client = self.lesyd.mqtt_client
+
+        if self.field_topics:
+            for field in fields:
+                client.publish(self.topic_field + field, self.serializer.value(self.state, field), retain=True)
+                flt = self.filters.get(field)
+                if flt:
+                    flt.published(self.state[field], now)
+            full = not self.state_published or now >= self.state_last_time + self.state_refresh
+        else:
+            full = True
+
+        if full:
+            self.logger.debug("Publish state %s",self.state)                                
+            client.publish(self.topic_state, self.serializer.dumps(self.state))
+            self.state_last_time = now        
+            if not self.field_topics:
+                for field, flt in self.filters.items():
+                    flt.published(self.state[field], now)
+                    self.deferred.pop(field, None)
+            if self.suppressed:
+                self.logger.debug("%d modifications suppressed by the deadbands", self.suppressed)
+
+        if self.binary_encoder:
+            client.publish(self.topic_binary_state, self.binary_encoder(self.state))
+
+        self.dirty.clear()
+        self.state_published = True
+
+    # Compute when process_deadline() shall be called again.
+    def next_deadline(self, now):
+
+        lesyd = self.lesyd
+        deadlines = []
+
+        if self.status == 'online':
+            deadlines.append(self.last_device_time + self.offline_delay())
+
+        if lesyd.mqtt_client.is_connected():
+            if not self.status_confirmed:
+                deadlines.append(self.status_time + self.STATUS_REPUBLISH_DELAY)
+            if not self.state_published:
+                if not self.unknown:
+                    deadlines.append(now)
+            elif self.dirty:
+                deadlines.append(now)
+            else:
+                # The periodic republication is not postponed by the deferred fields.
+                deadlines.append(self.state_last_time + self.state_refresh)
+                if self.deferred:
+                    deadlines.append(min(self.deferred.values()))
+
+        if lesyd.mqtt_sydpower.is_connected():
+            if self.requests.busy():
+                deadlines.append(self.requests.deadline())
+            elif not self.request_queue.empty():
+                deadlines.append(now)
+            else:
+                deadlines.append(min( poll.due() for poll in self.polls ))
+
+        # Reminder: a connection to a MQTT broker will wake up all devices. 
+        return min(deadlines) if deadlines else None
                     
     def update_state(self, field, value):
 
@@ -839,15 +1816,62 @@ class Device():
             self.update_state('ac_charging_level',level)            
 
         self.shadow[field] = value
-        if field in self.state:
+
+        # The history records the modifications and at least one value per
+        # minute so that the quiet periods are not empty.
+        history = self.lesyd.history
+        if history and field in self.state and type(value) in HISTORY_TYPES:
+            now = self.lesyd.clock()
+            last = self.history_times.get(field)
+            if last is None or now // 60 != last // 60 or self.state[field] != value:
+                history.record(self.mac, field, now, value)
+                self.history_times[field] = now
+
+        if field in self.state and (self.state[field] != value or field in self.unknown):
             self.state[field] = value
+            self.unknown.discard(field)
+            self.serializer.invalidate(field)
+
+            flt = self.filters.get(field)
+            if flt:
+                # The new value is stored in the state (and so it will be
+                # published with the whole state) but it does not count as a
+                # modification if it is filtered.
+                if not flt.accept(value):
+                    flt.suppressed += 1
+                    self.suppressed += 1
+                    self.deferred.pop(field, None)
+                    return
+                deadline = flt.earliest()
+                if deadline > self.lesyd.clock():
+                    self.deferred[field] = deadline
+                    return
+
+            self.dirty.add(field)
+
+    # A query of the history (see HistoryStore.execute_query).
+    def process_history_get(self, msg):
+        try:
+            request = json.loads(msg.payload)
+            if not isinstance(request, dict):
+                raise ValueError("not a JSON object")
+        except ValueError as err:
+            self.logger.error("Bad history request: %s", err)
+            response = json.dumps({ 'error': "bad request: {}".format(err) })
+            self.lesyd.mqtt_client.publish(self.topic_history_response, response)
+            return
+        # The response is published by the main loop (see LeSyd.on_history)
+        post_event = self.lesyd.post_event
+        self.lesyd.history.query(self.mac, request,
+                                 lambda response: post_event(Event('history', (self, response))))
+
                 
             
     def process_sydpower_state(self, msg):
 
         payload = msg.payload
 
-        self.last_device_time = time.time()
+        self.last_device_time = self.lesyd.clock()
 
         status = 'online'
         if len(payload)==1 :
@@ -863,10 +1887,11 @@ class Device():
                 pass
 
         self.set_status(status) 
+        self.wake()
         
     def process_sydpower_response(self, msg):
         #print("=== process_response_msg by device", self.name )
-        now = time.time()
+        now = self.lesyd.clock()
         
         payload = msg.payload
 
@@ -881,86 +1906,47 @@ class Device():
                 raise Exception("bad channel")
             
             func = payload[1]
+
+            completed = self.requests.complete(func, self.get_word(payload,2), now)
+            if completed:
+                self.logger.debug("Request completed in %.3fs (srtt=%.3fs)",
+                                  now - completed.sent_time, self.requests.srtt)
+
             if func == self.FUNC_READ_HOLDING_REGISTERS:
 
                 first = self.get_word(payload,2)
                 count = self.get_word(payload,4)
-                if first != 0 or count != 80 :
-                    raise Exception("partial data")
-                data = self.get_words(payload, 6, 80)
-
-                self.holding_response_time = now 
-
-                # Most holding registers are redundant with an input register
-                # but it is better to update the state as soon as possible.
-                
-                self.update_state( 'ac_silent_charging', bool(data[HREG_AC_SILENT_CHARGING]) )
-                self.update_state( 'ac_output',  bool(data[HREG_AC_OUTPUT]) ) 
-                self.update_state( 'dc_output',  bool(data[HREG_DC_OUTPUT]) ) 
-                self.update_state( 'usb_output', bool(data[HREG_USB_OUTPUT]) ) 
-                self.update_state( 'dc_max_charging_current', data[HREG_DC_MAX_CHARGING_CURRENT] ) 
-                self.update_state( 'ac_booking_charging', data[HREG_AC_BOOKING_CHARGING] )
-                self.update_state( 'key_sound', bool(data[HREG_KEY_SOUND]) )
-                self.update_state( 'ac_charging_rate', data[HREG_AC_CHARGING_RATE] )
+                values = self.holding_decoder.decode_range(payload, 6, first, count,
+                                                           self.holding_registers)
 
-                self.update_state( 'discharge_lower_limit',   data[HREG_DISCHARGE_LOWER_LIMIT]/10.0 )
-                self.update_state( 'ac_charging_upper_limit', data[HREG_AC_CHARGING_UPPER_LIMIT]/10.0 )
+                changes = 0
+                for field, value in values:
+                    if self.shadow.get(field) != value:
+                        changes += 1
+                    self.update_state(field, value)
 
+                poll = self.polls_by_key.get(payload[1:6])
+                if poll:
+                    poll.last = now 
+                    poll.interval = self.poll_interval(poll, changes, now)
 
             elif func == self.FUNC_READ_INPUT_REGISTERS:
 
                 first = self.get_word(payload,2)
                 count = self.get_word(payload,4)
-                if first != 0 or count != 80 :
-                    raise Exception("partial data")
-                data = self.get_words(payload, 6, 80)
-                
-                self.input_response_time = now 
-                
-                self.update_state( 'state_of_charge', data[IREG_STATE_OF_CHARGE] / 10.0 ) 
-               
-                status_bits = data[IREG_STATUS_BITS]
-                self.update_state( 'ac_output',  (status_bits & (1<<11)) != 0 ) 
-                self.update_state( 'dc_output',  (status_bits & (1<<10)) != 0 ) 
-                self.update_state( 'usb_output', (status_bits & (1<<9)) != 0 ) 
-                # TODO: we could also provide the status_bits in the state.  
+                values = self.input_decoder.decode_range(payload, 6, first, count,
+                                                         self.input_registers)
                 
-                self.update_state( 'total_input_power', data[IREG_TOTAL_INPUT_POWER] ) 
-
-                self.update_state( 'charging_power', data[IREG_AC_CHARGING_POWER]+data[IREG_DC_CHARGING_POWER] ) 
-                self.update_state( 'ac_charging_power', data[IREG_AC_CHARGING_POWER] ) 
-                self.update_state( 'dc_charging_power', data[IREG_DC_CHARGING_POWER] ) 
-
-                # There is no register for the ac_input_power but we can infer it
-                # from the total_input_power (so AC+DC) and dc_charging_power
-                # HOW ACCURATE IS THAT?
-                if self.guess_ac_input_power:
-                    self.update_state( 'ac_input_power', max(0,data[IREG_TOTAL_INPUT_POWER] - data[IREG_DC_CHARGING_POWER] ) )
-                
-                self.update_state( 'ac_output_power', data[IREG_AC_OUTPUT_POWER] ) 
-                self.update_state( 'ac_booking_charging', data[IREG_AC_BOOKING_CHARGING] ) 
-                self.update_state( 'ac_charging_rate', data[IREG_AC_CHARGING_RATE] )
-                self.update_state( 'usb_output_power',
-                                   (
-                                       data[IREG_USB_OUTPUT_POWER_1]+
-                                       data[IREG_USB_OUTPUT_POWER_2]+
-                                       data[IREG_USB_OUTPUT_POWER_3]+
-                                       data[IREG_USB_OUTPUT_POWER_4]+
-                                       data[IREG_USB_OUTPUT_POWER_5]+
-                                       data[IREG_USB_OUTPUT_POWER_6]
-                                   ) / 10.0
-                                  ) 
-                self.update_state( 'dc_output_power',
-                                   (
-                                       data[IREG_LED_POWER]+
-                                       data[IREG_DC_OUTPUT_POWER_1]
-                                   ) / 10.0
-                                  )
-
-                
-
+                changes = 0
+                for field, value in values:
+                    if self.shadow.get(field) != value:
+                        changes += 1
+                    self.update_state(field, value)
 
-                self.update_state( 'led', self.LED_CHOICES[data[IREG_LED_STATE] & 0x3]) 
+                poll = self.polls_by_key.get(payload[1:6])
+                if poll:
+                    poll.last = now 
+                    poll.interval = self.poll_interval(poll, changes, now)
 
             elif func == self.FUNC_WRITE_HOLDING_REGISTER:
                 # This is a device response to a valid FUNC_WRITE_HOLDING_REGISTER request.
@@ -1023,8 +2009,13 @@ class Device():
                         self.update_state( 'dc_max_charging_current', value )
 
                 if not ok:
-                    # provoque a request for holding registers
-                    self.holding_response_time = 0
+                    # Read back the register to figure out its actual value.
+                    if hreg < COUNT_HREG:
+                        self.request_queue.put(self.encode_ReadHoldingRegisters(hreg, 1))
+                    else:
+                        for poll in self.polls:
+                            if poll.payload[1] == self.FUNC_READ_HOLDING_REGISTERS:
+                                poll.last = 0.0
             elif func == self.FUNC_WRITE_HOLDING_REGISTER & 0x80:
                 # TODO: this is an error response on FUNC_WRITE_HOLDING_REGISTER
                 pass
@@ -1034,6 +2025,12 @@ class Device():
         except Exception as e:
             self.logger.error("%s",repr(e))
 
+        # Do not wait for the next deadline to send the next request.
+        if self.lesyd.mqtt_sydpower.is_connected():
+            self.send_next_request(now)
+
+        self.wake()
+
 
     # Convert a payload to a bool
     def payload_to_bool(self, payload):
@@ -1060,6 +2057,7 @@ class Device():
         value = msg.payload.decode()
         if self.status == value:
             self.status_confirmed = True            
+            self.wake()
 
     def request_ac_silent_charging(self, value:bool):
         if type(value) != bool:
@@ -1077,78 +2075,102 @@ class Device():
         self.request_queue.put(request)
 
     
+    # Process a message received on a command topic 'lesyd/DEVICE/state/set/COMMAND'
     def process_command(self, msg):
 
-        if msg.topic.startswith(self.topic_state) : 
-            command = msg.topic[ len(self.topic_state) : ]
-        
-            self.logger.debug("Processing command %s", command)
-            try:            
-                if command=='/set/ac_output':
-                    # HREG_AC_OUTPUT may behaves as a toggle regardless of the written value.
-                    # so make sure that we only write when a toggle is requested.
-                    value = self.payload_to_bool(msg.payload)
-                    if value != self.shadow['ac_output'] :
-                      request = self.encode_WriteHoldingRegister(HREG_AC_OUTPUT, int(value))
-                      self.request_queue.put(request)
-                elif command=='/set/dc_output':
-                    # HREG_DC_OUTPUT may have a strange behavior so only write when a toggle is requested.
-                    value = self.payload_to_bool(msg.payload)
-                    if value != self.shadow['dc_output'] :
-                      request = self.encode_WriteHoldingRegister(HREG_DC_OUTPUT, int(value))
-                      self.request_queue.put(request)
-                elif command=='/set/usb_output':
-                    value   = int(self.payload_to_bool(msg.payload))
-                    request = self.encode_WriteHoldingRegister(HREG_USB_OUTPUT, value)
-                    self.request_queue.put(request)  
-                elif command=='/set/ac_silent_charging':
-                    if self.shadow['ac_mode'] == 'manual':
-                        value   = self.payload_to_bool(msg.payload)
-                        self.request_ac_silent_charging(value)
-                elif command=='/set/key_sound':
-                    value   = int(self.payload_to_bool(msg.payload))
-                    request = self.encode_WriteHoldingRegister(HREG_KEY_SOUND, value)
-                    self.request_queue.put(request)  
-                elif command=='/set/led':                    
-                    value = None
-                    arg = msg.payload.decode().lower()
-                    for i in range(len(self.LED_CHOICES)):
-                        if arg == self.LED_CHOICES[i].lower():
-                            value = i
-                            break
-                    if type(value) == int:
-                        request = self.encode_WriteHoldingRegister(HREG_LED, value)
-                        self.request_queue.put(request)                    
-                elif command=='/set/ac_booking_charging':
-                    if self.shadow['ac_mode'] == 'manual':
-                        value   = self.payload_to_int(msg.payload,0,self.MAX_AC_BOOKING_CHARGING)
-                        self.request_ac_booking_charging(value)
-                elif command=='/set/dc_max_charging_current':
-                    value   = int(self.payload_to_int(msg.payload,1,self.DC_MAX_CHARGING_CURRENT))
-                    request = self.encode_WriteHoldingRegister(HREG_DC_MAX_CHARGING_CURRENT, value)
-                    self.request_queue.put(request)  
-                elif command=='/set/discharge_lower_limit':
-                    value   = int(self.payload_to_float(msg.payload,
-                                                        self.MIN_DISCHARGE_LOWER_LIMIT/10.0,
-                                                        self.MAX_DISCHARGE_LOWER_LIMIT/10.0)*10.0)
-                    request = self.encode_WriteHoldingRegister(HREG_DISCHARGE_LOWER_LIMIT, value)
-                    self.request_queue.put(request)  
-                elif command=='/set/ac_charging_upper_limit':
-                    value   = int(self.payload_to_float(msg.payload,
-                                                        self.MIN_AC_CHARGING_UPPER_LIMIT/10.0,
-                                                        self.MAX_AC_CHARGING_UPPER_LIMIT/10.0)*10.0)
-                    request = self.encode_WriteHoldingRegister(HREG_AC_CHARGING_UPPER_LIMIT, value)
-                    self.request_queue.put(request)
-                elif command=='/set/ac_mode':
-                    arg = msg.payload.decode().lower()
-                    if arg in self.AC_MODE_CHOICES:
-                        if self.shadow['ac_mode'] != arg:
-                            self.update_state('ac_mode',arg)
-                            self.maintain_ac_mode() 
-                else:
-                    self.logger.error("Unknown command %s",command) 
-            except ValueError:
-                pass
+        command = msg.topic.rpartition('/')[2]
+        handler = self.command_handlers.get(command)
+        if handler is None:
+            self.logger.error("Unknown command %s",command)
+            return
+
+        self.logger.debug("Processing command %s", command)
+        try:            
+            handler(msg.payload)
+        except ValueError:
+            pass
+        self.wake()
+
+    def command_ac_output(self, payload):
+        # HREG_AC_OUTPUT may behaves as a toggle regardless of the written value.
+        # so make sure that we only write when a toggle is requested.
+        value = self.payload_to_bool(payload)
+        if value != self.shadow['ac_output'] :
+            request = self.encode_WriteHoldingRegister(HREG_AC_OUTPUT, int(value))
+            self.request_queue.put(request)
+
+    def command_dc_output(self, payload):
+        # HREG_DC_OUTPUT may have a strange behavior so only write when a toggle is requested.
+        value = self.payload_to_bool(payload)
+        if value != self.shadow['dc_output'] :
+            request = self.encode_WriteHoldingRegister(HREG_DC_OUTPUT, int(value))
+            self.request_queue.put(request)
+
+    def command_usb_output(self, payload):
+        value   = int(self.payload_to_bool(payload))
+        request = self.encode_WriteHoldingRegister(HREG_USB_OUTPUT, value)
+        self.request_queue.put(request)  
+
+    def command_ac_silent_charging(self, payload):
+        if self.shadow['ac_mode'] == 'manual':
+            value   = self.payload_to_bool(payload)
+            self.request_ac_silent_charging(value)
+
+    def command_key_sound(self, payload):
+        value   = int(self.payload_to_bool(payload))
+        request = self.encode_WriteHoldingRegister(HREG_KEY_SOUND, value)
+        self.request_queue.put(request)  
+
+    def command_led(self, payload):
+        value = None
+        arg = payload.decode().lower()
+        for i in range(len(self.LED_CHOICES)):
+            if arg == self.LED_CHOICES[i].lower():
+                value = i
+                break
+        if type(value) == int:
+            request = self.encode_WriteHoldingRegister(HREG_LED, value)
+            self.request_queue.put(request)                    
+
+    def command_ac_booking_charging(self, payload):
+        if self.shadow['ac_mode'] == 'manual':
+            value   = self.payload_to_int(payload,0,self.MAX_AC_BOOKING_CHARGING)
+            self.request_ac_booking_charging(value)
+
+    def command_dc_max_charging_current(self, payload):
+        value   = int(self.payload_to_int(payload,1,self.DC_MAX_CHARGING_CURRENT))
+        request = self.encode_WriteHoldingRegister(HREG_DC_MAX_CHARGING_CURRENT, value)
+        self.request_queue.put(request)  
+
+    def command_discharge_lower_limit(self, payload):
+        value   = int(self.payload_to_float(payload,
+                                            self.MIN_DISCHARGE_LOWER_LIMIT/10.0,
+                                            self.MAX_DISCHARGE_LOWER_LIMIT/10.0)*10.0)
+        request = self.encode_WriteHoldingRegister(HREG_DISCHARGE_LOWER_LIMIT, value)
+        self.request_queue.put(request)  
+
+    def command_ac_charging_upper_limit(self, payload):
+        value   = int(self.payload_to_float(payload,
+                                            self.MIN_AC_CHARGING_UPPER_LIMIT/10.0,
+                                            self.MAX_AC_CHARGING_UPPER_LIMIT/10.0)*10.0)
+        request = self.encode_WriteHoldingRegister(HREG_AC_CHARGING_UPPER_LIMIT, value)
+        self.request_queue.put(request)
+
+    # Poll at 'min_refresh' for the specified number of seconds.
+    # Typically, when a dashboard is opened.
+    def command_burst(self, payload):
+        duration = self.payload_to_int(payload, 0, self.MAX_BURST_DURATION)
+        now = self.lesyd.clock()
+        self.burst_until = now + duration 
+        for poll in self.polls:
+            poll.interval = self.poll_interval(poll, 0, now)
+
+    def command_ac_mode(self, payload):
+        arg = payload.decode().lower()
+        if arg in self.AC_MODE_CHOICES:
+            if self.shadow['ac_mode'] != arg:
+                self.update_state('ac_mode',arg)
+                self.maintain_ac_mode() 
 
     #        
     # low, high, high_is_silent = ac_charging_low_high()
@@ -1189,15 +2211,15 @@ class Device():
     # 
     def maintain_ac_mode(self):
         
-        if not main.mqtt_sydpower.is_connected():
+        if not self.lesyd.mqtt_sydpower.is_connected():
             return
         
         # We are not in a hurry. Wait until all outgoing messages are processed 
-        if self.current_request or not self.request_queue.empty():
+        if self.requests.busy() or not self.request_queue.empty():
             return
 
         # We are still in the startup phase.
-        if None in self.state.values():
+        if self.unknown:
             return
 
         ac_mode = self.shadow['ac_mode'] 
@@ -1237,28 +2259,16 @@ class Device():
                                        
     # Compute a CRC for a modbus message    
     def compute_crc(self, buf, size:int):
-        crc = 0xFFFF
-        for i in range(size):
-            crc ^= buf[i]
-            for bit in range(8):
-                if crc & 0x0001:
-                    crc >>= 1
-                    crc ^= 0xA001
-                else:
-                    crc >>= 1
-
+        crc = modbus_crc16(buf, size)
         return [ (crc & 0xFF00) >> 8 , crc & 0xFF ]
 
     def append_crc(self, buf: bytearray):
-        hi,lo = self.compute_crc(buf,len(buf))
-        buf.append(hi)
-        buf.append(lo)
+        buf += modbus_crc16(buf, len(buf)).to_bytes(2, 'big')
 
     def check_crc(self, buf):
         if len(buf) < 2:
             return False
-        hi,lo = self.compute_crc(buf,len(buf)-2)
-        return (hi==buf[-2] and lo==buf[-1])
+        return modbus_crc16(buf, len(buf)-2) == ((buf[-2]<<8) | buf[-1])
 
     # Extract a single 16 word from a bytes or bytearray buffer
     def get_word(self, buf: bytes|bytearray , index:int) -> int:
@@ -1267,10 +2277,6 @@ class Device():
         except:
             raise Exception('[modbus] malformed message')
 
-    # Extract n 16bit words from a bytes of bytearray buffer 
-    def get_words(self, buf: bytes|bytearray, index:int, n:int) -> [int] :
-        return list( self.get_word(buf,index+2*x) for x in range(n) )
-
     # Append a 16 bit word at the end of bytearray 
     def append_word(self, buf:bytearray ,value:int) -> None :
         buf.append((value>>8)&0xFF)
@@ -1280,36 +2286,960 @@ class Device():
         if len(buf) != 4+arg_size+payload_size :
             raise Exception('[modbus] malformed message')
 
-    def encode_ReadHoldingRegisters(self, start:int, count:int) -> bytearray:
-        msg = bytearray()
-        msg.append(self.MODBUS_CHANNEL)
-        msg.append(self.FUNC_READ_HOLDING_REGISTERS)
-        self.append_word(msg,start)
-        self.append_word(msg,count)
-        self.append_crc(msg)
-        return msg
-
-    def encode_ReadInputRegisters(self, start:int, count:int) -> bytearray:
-        msg = bytearray()
-        msg.append(self.MODBUS_CHANNEL)
-        msg.append(self.FUNC_READ_INPUT_REGISTERS)
-        self.append_word(msg,start)
-        self.append_word(msg,count)
-        self.append_crc(msg)
-        return msg
+    def encode_ReadHoldingRegisters(self, start:int, count:int) -> bytes:
+        return encode_modbus_request(self.MODBUS_CHANNEL, self.FUNC_READ_HOLDING_REGISTERS, start, count)
+
+    def encode_ReadInputRegisters(self, start:int, count:int) -> bytes:
+        return encode_modbus_request(self.MODBUS_CHANNEL, self.FUNC_READ_INPUT_REGISTERS, start, count)
     
-    def encode_WriteHoldingRegister(self, index:int, value:int) -> bytearray:
-        msg = bytearray()
-        msg.append(self.MODBUS_CHANNEL)
-        msg.append(self.FUNC_WRITE_HOLDING_REGISTER)
-        self.append_word(msg,index)
-        self.append_word(msg,value)
-        self.append_crc(msg)
-        return msg
+    def encode_WriteHoldingRegister(self, index:int, value:int) -> bytes:
+        return encode_modbus_request(self.MODBUS_CHANNEL, self.FUNC_WRITE_HOLDING_REGISTER, index, value)
+
+
+# An event produced by the MQTT client threads or by a signal handler and
+# processed by the main loop. 
+class Event():
+
+    __slots__ = ('kind', 'args', 'time', 'key', 'droppable')
+
+    # key       An optional key. A queued event with the same key is replaced by the new one.
+    # droppable True if the event can be dropped when the queue is full.
+    def __init__(self, kind:str, args:tuple, key=None, droppable:bool=False):
+        self.kind = kind
+        self.args = args
+        self.time = time.perf_counter()   # to measure the event latency
+        self.key  = key
+        self.droppable = droppable
+
+# The queue of events consumed by the main loop.
+#
+# The main loop waits on a socket that is written each time an event is
+# added. That socket is also used as the signal wakeup fd so that signals
+# wake up the main loop immediately.
+#
+# The queue is bounded by 'maxsize' (0 means unbounded):
+#  - an event with a key replaces the arguments of the queued event with the
+#    same key (if any) so only the newest data is processed, in the position
+#    of the oldest one.
+#  - a droppable event is dropped when the queue is full.
+#  - other events are always queued. 
+class EventQueue():
+
+    def __init__(self, maxsize:int=0):
+        self.events  = collections.deque()
+        self.pending = {}       # key -> queued event
+        self.maxsize = maxsize
+        self.lock    = threading.Lock()
+        self.coalesced = 0      # number of events replaced by a newer one
+        self.dropped   = 0      # number of events dropped because the queue was full
+        self.overflows = 0      # number of events queued while the queue was full
+        self.high_watermark = 0 # maximal number of queued events
+        self.rsock, self.wsock = socket.socketpair()
+        self.rsock.setblocking(False)
+        self.wsock.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.rsock, selectors.EVENT_READ)
+
+    def __len__(self):
+        return len(self.events)
+
+    def __str__(self):
+        return "{} queued, max {}, {} coalesced, {} dropped, {} overflows".format(
+            len(self.events), self.high_watermark, self.coalesced, self.dropped, self.overflows)
+
+    # The file descriptor to use with signal.set_wakeup_fd()
+    def wakeup_fd(self) -> int:
+        return self.wsock.fileno()
+
+    # Return False if the event was dropped.
+    def put(self, event:Event) -> bool:
+        with self.lock:
+            key = event.key
+            if key is not None:
+                queued = self.pending.get(key)
+                if queued is not None:
+                    # The main loop is already woken up by the queued event.
+                    # The latency is measured from the replacing event.
+                    queued.args = event.args
+                    queued.time = event.time
+                    self.coalesced += 1
+                    return True
+            size = len(self.events)
+            if self.maxsize and size >= self.maxsize:
+                if event.droppable:
+                    self.dropped += 1
+                    return False
+                self.overflows += 1
+            self.events.append(event)
+            if key is not None:
+                self.pending[key] = event
+            if size >= self.high_watermark:
+                self.high_watermark = size+1
+        try:
+            self.wsock.send(b'\0')
+        except BlockingIOError:
+            # The socket is full so the main loop will wake up anyway.
+            pass
+        return True
 
+    # Wait until an event is available or until the timeout expires (None means forever)
+    def wait(self, timeout):
+        if not self.events:
+            self.selector.select(timeout)
+        try:
+            while self.rsock.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    # Return the next event or None 
+    def get(self):
+        with self.lock:
+            if not self.events:
+                return None
+            event = self.events.popleft()
+            if event.key is not None:
+                del self.pending[event.key]
+            return event
+
+# Statistics about the delay between the creation of an event and its processing.
+class LatencyStats():
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = 0.0
+        self.max   = 0.0
+
+    def add(self, latency:float):
+        self.count += 1
+        self.total += latency
+        if latency > self.max:
+            self.max = latency
+
+    def __str__(self):
+        if self.count == 0:
+            return "no event"
+        return "{} events, average {:.1f}us, max {:.1f}us".format(self.count,
+                                                               self.total/self.count*1e6,
+                                                               self.max*1e6)
+
+# Capture files of the Sydpower traffic (see '--capture' and '--replay')
+#
+# A capture file starts with CAPTURE_MAGIC followed by records made of a
+# CAPTURE_RECORD header (time, direction, topic length, payload length) 
+# followed by the topic and the payload.
+CAPTURE_MAGIC    = b'LSYDCAP1'
+CAPTURE_RECORD   = struct.Struct('<dBHI')
+CAPTURE_INBOUND  = 0   # from a device
+CAPTURE_OUTBOUND = 1   # to a device
+
+# Append the Sydpower frames to a capture file.
+#
+# The file is written by the main thread only and flushed periodically
+# (see LeSyd.flush_capture).
+class CaptureWriter():
+
+    def __init__(self, path:str):
+        self.path = path
+        self.file = open(path, 'ab', buffering=1<<16)
+        if self.file.tell() == 0:
+            self.file.write(CAPTURE_MAGIC)
+        self.records = 0
+
+    def record(self, direction:int, topic:str, payload, now:float):
+        topic = topic.encode()
+        if isinstance(payload, str):
+            payload = payload.encode()
+        self.file.write(CAPTURE_RECORD.pack(now, direction, len(topic), len(payload)))
+        self.file.write(topic)
+        self.file.write(payload)
+        self.records += 1
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+# Read the records of a capture file. 
+#
+# The file is memory-mapped so large captures are not loaded in memory.
+class CaptureReader():
+
+    def __init__(self, path:str):
+        self.path = path
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < len(CAPTURE_MAGIC):
+                raise ValueError("'{}' is not a capture file".format(path))
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(CAPTURE_MAGIC)] != CAPTURE_MAGIC:
+            raise ValueError("'{}' is not a capture file".format(path))
+        self.truncated = False
+
+    # Yield tuples (time, direction, topic, payload)
+    def __iter__(self):
+        data = self.map
+        size = len(data)
+        pos  = len(CAPTURE_MAGIC)
+        header = CAPTURE_RECORD.size
+        unpack = CAPTURE_RECORD.unpack_from
+        while pos + header <= size:
+            when, direction, tlen, plen = unpack(data, pos)
+            start = pos + header
+            end = start + tlen + plen
+            if end > size:
+                break
+            yield when, direction, data[start:start+tlen].decode(), data[start+tlen:end]
+            pos = end
+        self.truncated = pos != size
+
+    def close(self):
+        self.map.close()
+
+# A local history of the numeric state fields stored in SQLite.
+#
+# The values are recorded by Device.update_state() when they change and at
+# least once per minute while the device is polled. The main loop only
+# appends them to a deque: a background thread writes them in batches every
+# FLUSH_INTERVAL seconds so the main loop never waits for the disk. A batch
+# that cannot be written is retried with the next one. The same thread answers the queries, since a SQLite connection
+# should only be used by one thread.
+#
+# Three tables with decreasing resolutions are maintained:
+#
+#   - 'raw'    every recorded value, kept 'raw_retention' seconds.
+#   - 'minute' min/max/sum/count per minute, kept 'minute_retention' seconds.
+#   - 'hour'   min/max/sum/count per hour, kept forever.
+#
+# The rollups are updated for each batch (no need to recompute them from
+# the raw values) and the expired rows are removed every PRUNE_INTERVAL
+# seconds.
+#
+HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS raw (
+    device TEXT NOT NULL, field TEXT NOT NULL, time REAL NOT NULL, value REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS raw_index ON raw (device, field, time);
+CREATE TABLE IF NOT EXISTS minute (
+    device TEXT NOT NULL, field TEXT NOT NULL, time INTEGER NOT NULL,
+    min REAL NOT NULL, max REAL NOT NULL, sum REAL NOT NULL, count INTEGER NOT NULL,
+    PRIMARY KEY (device, field, time)
+);
+CREATE TABLE IF NOT EXISTS hour (
+    device TEXT NOT NULL, field TEXT NOT NULL, time INTEGER NOT NULL,
+    min REAL NOT NULL, max REAL NOT NULL, sum REAL NOT NULL, count INTEGER NOT NULL,
+    PRIMARY KEY (device, field, time)
+);
+"""
+
+# Merge a batch of aggregates into a rollup table
+HISTORY_ROLLUP = """
+INSERT INTO {0} (device, field, time, min, max, sum, count) VALUES (?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (device, field, time) DO UPDATE SET
+    min = min({0}.min, excluded.min), max = max({0}.max, excluded.max),
+    sum = {0}.sum + excluded.sum, count = {0}.count + excluded.count
+"""
+
+# The types of the state values that are recorded
+HISTORY_TYPES = (int, float, bool)
+
+# The resolutions of the queries: table, period and columns of the response.
+HISTORY_RESOLUTIONS = {
+    'raw':    ('raw',    0,    ['time', 'value']),
+    'minute': ('minute', 60,   ['time', 'min', 'max', 'avg']),
+    'hour':   ('hour',   3600, ['time', 'min', 'max', 'avg']),
+}
+
+class HistoryStore():
+
+    # Interval between two batched writes (in seconds)
+    FLUSH_INTERVAL = 1.0
+
+    # Interval between two removals of the expired rows (in seconds)
+    PRUNE_INTERVAL = 3600
+
+    # The values recorded when that many values are waiting for the writer are dropped
+    MAX_PENDING = 100000
+
+    # The maximal number of rows in a query response
+    MAX_QUERY_ROWS = 10000
+
+    def __init__(self, path:str, raw_retention:float, minute_retention:float, clock=time.time):
+        self.path = path
+        self.raw_retention    = raw_retention
+        self.minute_retention = minute_retention
+        self.clock   = clock
+        self.logger  = logging.getLogger('lesyd.history')
+        # Opened here so that errors are reported at startup but only used
+        # by the writer thread.
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(HISTORY_SCHEMA)
+        self.samples  = collections.deque()   # (device, field, time, value)
+        self.queries  = collections.deque()   # (device, request, callback)
+        self.wakeup   = threading.Event()
+        self.stopping = False
+        self.written  = 0
+        self.dropped  = 0
+        self.last_prune = 0.0
+        self.thread = threading.Thread(target=self.run, name='history', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    # Stop the writer thread after writing the pending values
+    def stop(self):
+        self.stopping = True
+        self.wakeup.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        self.db.close()
+
+    # Called by the main loop. Never blocks.
+    def record(self, device:str, field:str, now:float, value):
+        if len(self.samples) >= self.MAX_PENDING:
+            self.dropped += 1
+            return
+        self.samples.append( (device, field, now, float(value)) )
+
+    # Called by the main loop. 'callback' is called by the writer thread
+    # with the response (a dict).
+    def query(self, device:str, request:dict, callback):
+        self.queries.append( (device, request, callback) )
+        self.wakeup.set()
+
+    def run(self):
+        while not self.stopping:
+            self.wakeup.wait(self.FLUSH_INTERVAL)
+            self.wakeup.clear()
+            try:
+                self.flush()
+                while self.queries:
+                    device, request, callback = self.queries.popleft()
+                    callback(self.answer_query(device, request))
+                now = self.clock()
+                if now - self.last_prune >= self.PRUNE_INTERVAL:
+                    self.prune(now)
+                    self.last_prune = now
+            except sqlite3.Error as err:
+                self.logger.error("History: %s", err)
+        try:
+            self.flush()
+        except sqlite3.Error as err:
+            self.logger.error("History: %s", err)
+
+    # Write the pending values and update the rollups (in a single transaction).
+    def flush(self):
+        samples = self.samples
+        count = len(samples)
+        if count == 0:
+            return
+        batch = [ samples.popleft() for i in range(count) ]
+        try:
+            self.write(batch)
+        except sqlite3.Error:
+            # Retried with the next batch (e.g. when the database is locked
+            # by another worker) unless too many values are waiting.
+            if len(samples) + count <= self.MAX_PENDING:
+                samples.extendleft(reversed(batch))
+            else:
+                self.dropped += count
+            raise
+        self.written += count
+
+    def write(self, batch:list):
+        minutes = {}
+        hours   = {}
+        for device, field, now, value in batch:
+            for rollup, period in ( (minutes, 60), (hours, 3600) ):
+                key = (device, field, int(now // period) * period)
+                agg = rollup.get(key)
+                if agg is None:
+                    rollup[key] = [ value, value, value, 1 ]
+                else:
+                    if value < agg[0]:
+                        agg[0] = value
+                    if value > agg[1]:
+                        agg[1] = value
+                    agg[2] += value
+                    agg[3] += 1
+        with self.db:
+            self.db.executemany("INSERT INTO raw (device, field, time, value) VALUES (?, ?, ?, ?)", batch)
+            for table, rollup in ( ('minute', minutes), ('hour', hours) ):
+                self.db.executemany(HISTORY_ROLLUP.format(table),
+                                    [ key + tuple(agg) for key, agg in rollup.items() ])
+
+    def prune(self, now:float):
+        with self.db:
+            self.db.execute("DELETE FROM raw WHERE time < ?", (now - self.raw_retention,))
+            self.db.execute("DELETE FROM minute WHERE time < ?", (now - self.minute_retention,))
+
+    # The finest resolution still available at time 'start'
+    def resolution(self, start:float, now:float) -> str:
+        if start >= now - self.raw_retention:
+            return 'raw'
+        if start >= now - self.minute_retention:
+            return 'minute'
+        return 'hour'
+
+    # Execute a query and return the response. A failed query gets an
+    # error response so a bad request cannot stop the writer thread.
+    def answer_query(self, device:str, request:dict) -> dict:
+        try:
+            return self.execute_query(device, request)
+        except Exception as err:
+            self.logger.error("History query %r: %r", request, err)
+            response = { 'error': "query failed: {}".format(err) }
+            if 'id' in request:
+                response['id'] = request['id']
+            return response
+
+    # Execute a query and return the response.
+    #
+    # The request is a dict with:
+    #   - field      the state field (mandatory)
+    #   - start      the start of the time range. A negative value is relative
+    #                to the current time. The default is -3600.
+    #   - end        the end of the time range (default is now)
+    #   - resolution 'raw', 'minute', 'hour' or 'auto' (the default)
+    #   - id         an optional value copied in the response
+    def execute_query(self, device:str, request:dict) -> dict:
+        response = {}
+        if 'id' in request:
+            response['id'] = request['id']
+        try:
+            now = self.clock()
+            field = request['field']
+            if type(field) is not str:
+                raise TypeError("'field' must be a string")
+            start = float(request.get('start', -3600))
+            end   = float(request.get('end', now))
+            if not (math.isfinite(start) and math.isfinite(end)):
+                raise ValueError("'start' and 'end' must be finite")
+            if start < 0:
+                start += now
+            if end < 0:
+                end += now
+            resolution = request.get('resolution', 'auto')
+            if resolution == 'auto':
+                resolution = self.resolution(start, now)
+            table, period, columns = HISTORY_RESOLUTIONS[resolution]
+        except (KeyError, TypeError, ValueError) as err:
+            response['error'] = "bad request: {}".format(err)
+            return response
+
+        if period:
+            sql = ("SELECT time, min, max, sum/count FROM {} WHERE device=? AND field=? "
+                   "AND time>=? AND time<=? ORDER BY time LIMIT ?").format(table)
+            start = int(start // period) * period
+        else:
+            sql = ("SELECT time, value FROM raw WHERE device=? AND field=? "
+                   "AND time>=? AND time<=? ORDER BY time LIMIT ?")
+        # Before the pending values are written, a recent range may look empty
+        self.flush()
+        rows = self.db.execute(sql, (device, field, start, end, self.MAX_QUERY_ROWS+1)).fetchall()
+        response.update({
+            'field':      field,
+            'resolution': resolution,
+            'start':      start,
+            'end':        end,
+            'columns':    columns,
+            'rows':       [ list(row) for row in rows[:self.MAX_QUERY_ROWS] ],
+            'truncated':  len(rows) > self.MAX_QUERY_ROWS,
+        })
+        return response
+
+    def __str__(self):
+        return "written={} pending={} dropped={}".format(self.written, len(self.samples), self.dropped)
+
+# The MQTT transports of paho
+PAHO_TRANSPORTS = {
+    'tcp':       'tcp',
+    'websocket': 'websockets',
+    'unix':      'unix',
+}
+
+# A clock that only advances when requested (see LeSyd.run_until).
+class ManualClock():
+
+    def __init__(self, start:float=0.0):
+        self.now = start
+
+    def __call__(self) -> float:
+        return self.now
+
+    def advance(self, delay:float):
+        self.now += delay
+
+    # Move the clock to 'when' (the clock never goes backward)
+    def set(self, when:float):
+        if when > self.now:
+            self.now = when
+
+class MemoryReasonCode():
+    is_failure = False
+    value = 0
+
+    def getName(self):
+        return 'Success'
+
+    def __str__(self):
+        return 'Success'
+
+class MemoryMessage():
+
+    def __init__(self, topic:str, payload:bytes, qos:int=0, retain:bool=False):
+        self.topic   = topic
+        self.payload = payload
+        self.qos     = qos
+        self.retain  = retain
+        self.mid     = 0
+
+class MemoryMessageInfo():
+    rc  = 0
+    mid = 0
+
+    def wait_for_publish(self, timeout=None):
+        pass
+
+    def is_published(self):
+        return True
+
+# An in-memory MQTT broker (see the 'memory' transport).
+#
+# The publications are delivered synchronously to the subscribed clients in
+# the thread of the publisher so the whole LeSyd/Device pipeline can be
+# driven without sockets nor network threads.
+class MemoryBroker():
+
+    def __init__(self, name:str):
+        self.name      = name
+        self.clients   = []
+        self.routes    = {}    # topic -> subscribed clients
+        self.retained  = {}    # topic -> retained MemoryMessage
+        self.observers = []    # callbacks called with (topic,payload) for each publication
+        self.lock      = threading.Lock()
+
+    def client(self):
+        return MemoryClient(self)
+
+    def subscribe(self, client, topic):
+        with self.lock:
+            if client not in self.clients:
+                self.clients.append(client)
+            self.routes.clear()
+            retained = [ msg for t, msg in self.retained.items() if mqtt.topic_matches_sub(topic, t) ]
+        for msg in retained:
+            client.deliver(msg)
+
+    def unsubscribe(self, client):
+        with self.lock:
+            if client in self.clients:
+                self.clients.remove(client)
+            self.routes.clear()
+
+    def publish(self, topic:str, payload, qos:int=0, retain:bool=False):
+        if payload is None:
+            payload = b''
+        elif isinstance(payload, str):
+            payload = payload.encode()
+        elif isinstance(payload, (int, float)):
+            payload = str(payload).encode()
+        for observer in self.observers:
+            observer(topic, payload)
+        msg = MemoryMessage(topic, payload, qos, retain)
+        clients = self.routes.get(topic)
+        if clients is None:
+            with self.lock:
+                clients = [ client for client in self.clients
+                            if any(mqtt.topic_matches_sub(sub, topic) for sub in client.subscriptions) ]
+                self.routes[topic] = clients
+        if retain:
+            if payload:
+                self.retained[topic] = msg
+            else:
+                self.retained.pop(topic, None)
+        for client in clients:
+            client.deliver(msg)
+
+MEMORY_BROKERS = {}
+
+# Get the in-memory broker identified by the hostname of a 'memory' transport
+def memory_broker(name:str) -> MemoryBroker:
+    broker = MEMORY_BROKERS.get(name)
+    if broker is None:
+        broker = MEMORY_BROKERS[name] = MemoryBroker(name)
+    return broker
+
+# A client of a MemoryBroker implementing the subset of the paho client
+# API used by LeSyd.
+class MemoryClient():
+
+    def __init__(self, broker:MemoryBroker):
+        self.broker        = broker
+        self.subscriptions = []
+        self.connected     = False
+        self.will          = None
+        self.userdata      = None
+        self.on_connect      = None
+        self.on_connect_fail = None
+        self.on_disconnect   = None
+        self.on_message      = None
+        self.on_subscribe    = None
+
+    def tls_set(self, *args, **kwargs):
+        pass
+
+    def tls_insecure_set(self, value):
+        pass
+
+    def username_pw_set(self, username, password=None):
+        pass
+
+    def will_set(self, topic, payload=None, qos=0, retain=False):
+        self.will = (topic, payload, qos, retain)
+
+    def connect_async(self, host, port=0, keepalive=60):
+        pass
+
+    def reconnect(self):
+        self.connected = True
+        if self.on_connect:
+            self.on_connect(self, self.userdata, None, MemoryReasonCode(), None)
+
+    def loop_start(self):
+        self.reconnect()
+
+    def loop_stop(self):
+        pass
+
+    def loop_read(self):
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def loop_write(self):
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def loop_misc(self):
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def is_connected(self):
+        return self.connected
+
+    def subscribe(self, topic, qos=0):
+        self.subscriptions.append(topic)
+        self.broker.subscribe(self, topic)
+        return (mqtt.MQTT_ERR_SUCCESS, len(self.subscriptions))
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.broker.publish(topic, payload, qos, retain)
+        return MemoryMessageInfo()
+
+    def disconnect(self):
+        if not self.connected:
+            return
+        self.connected = False
+        self.subscriptions = []
+        self.broker.unsubscribe(self)
+        if self.on_disconnect:
+            self.on_disconnect(self, self.userdata, None, MemoryReasonCode(), None)
+
+    # Simulate a lost connection: the will is published.
+    def drop(self):
+        if self.will:
+            self.broker.publish(*self.will)
+        self.disconnect()
+
+    def deliver(self, msg:MemoryMessage):
+        if self.connected and self.on_message:
+            self.on_message(self, self.userdata, msg)
+
+# Run LeSyd in a single asyncio event loop (see '--engine asyncio').
+#
+# The sockets of the paho clients are monitored by the asyncio loop using
+# the 'external event loop' API of paho. The MQTT callbacks are then called
+# by the loop itself so the events are processed immediately, without the
+# network threads and the event queue of the default engine. The deadlines
+# of the devices are still managed by the Scheduler. 
+class AsyncioEngine():
+
+    # Delay before trying to reconnect to the MQTT server (in seconds)
+    RECONNECT_DELAY = 5
+
+    # Interval between two calls of loop_misc() (in seconds)
+    MISC_INTERVAL = 1
+
+    def __init__(self, lesyd):
+        self.lesyd  = lesyd
+        self.loop   = None
+        self.wakeup = None
+        self.misc_tasks = {}
+        self.pending = collections.deque()
+        self.dispatching = False
+
+    def run(self):
+        return asyncio.run(self.main())
+
+    async def main(self):
+        lesyd = self.lesyd
+        self.loop   = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        self.thread_id = threading.get_ident()
+
+        # The events are produced in the loop so they can be processed immediately.
+        lesyd.post_event = self.dispatch
+        self.loop.add_signal_handler(signal.SIGINT, lesyd.signal_handler, signal.SIGINT, None)
+
+        lesyd.create_mqtt_clients()
+        for client in lesyd.mqtt_clients:
+            self.attach(client)
+            self.connect(client)
+
+        lesyd.start_services()
+
+        while lesyd.result is None:
+            timeout = lesyd.scheduler.timeout(lesyd.clock())
+            timer = None
+            if timeout is not None:
+                timer = self.loop.call_later(timeout, self.wakeup.set)
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            if timer:
+                timer.cancel()
+            if not lesyd.result is None:
+                break
+            lesyd.scheduler.run_due(lesyd.clock())
+
+        lesyd.graceful_shutdown(0)
+        return lesyd.result
+
+    # The events produced while processing an event (e.g. by the memory
+    # transport) are processed after it. The events produced by other
+    # threads are transferred to the loop.
+    def dispatch(self, event):
+        if threading.get_ident() != self.thread_id:
+            self.loop.call_soon_threadsafe(self.dispatch, event)
+            return
+        self.pending.append(event)
+        if self.dispatching:
+            return
+        self.dispatching = True
+        try:
+            while self.pending:
+                self.lesyd.process_event(self.pending.popleft())
+        finally:
+            self.dispatching = False
+        self.wakeup.set()
+
+    def attach(self, client):
+        client.on_socket_open            = self.on_socket_open
+        client.on_socket_close           = self.on_socket_close
+        client.on_socket_register_write   = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def connect(self, client):
+        try:
+            client.reconnect()
+        except OSError as err:
+            self.lesyd.logger.debug("%s", repr(err))
+            self.lesyd.post_event( Event('connect_fail', (client, None)) )
+            self.schedule_reconnect(client)
+
+    def schedule_reconnect(self, client):
+        self.lesyd.scheduler.schedule((self, client),
+                                      self.lesyd.clock() + self.RECONNECT_DELAY,
+                                      functools.partial(self.connect, client))
+        self.wakeup.set()
+
+    def on_socket_open(self, client, userdata, sock):
+        self.loop.add_reader(sock, client.loop_read)
+        self.misc_tasks[client] = self.loop.create_task(self.misc_loop(client))
+
+    def on_socket_close(self, client, userdata, sock):
+        self.loop.remove_reader(sock)
+        self.loop.remove_writer(sock)
+        task = self.misc_tasks.pop(client, None)
+        if task:
+            task.cancel()
+        if self.lesyd.result is None:
+            self.schedule_reconnect(client)
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.loop.add_writer(sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.remove_writer(sock)
+
+    # Handle the keepalive of the MQTT connection
+    async def misc_loop(self, client):
+        while client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(self.MISC_INTERVAL)
+
+# The index of the worker process that manages a device (see '--workers')
+def device_worker(dev, count:int) -> int:
+    if dev.worker is not None:
+        return dev.worker
+    # Python's hash() is randomized so use a stable hash of the MAC address.
+    return zlib.crc32(dev.mac.encode()) % count
+
+# A worker process started by the Supervisor
+class WorkerProcess():
+
+    def __init__(self, index:int, devices:list):
+        self.index   = index
+        self.devices = devices   # The names of the devices managed by that worker
+        self.process = None      # The subprocess.Popen object while running
+        self.started = 0         # The time of the last start
+        self.starts  = 0         # The number of starts 
+        self.exit_code = None    # The exit code of the last process
+        self.restart_time = 0    # The earliest time of the next start
+        self.restart_delay = Supervisor.MIN_RESTART_DELAY
+
+    def health(self):
+        return {
+            'index':     self.index,
+            'pid':       self.process.pid if self.process else None,
+            'running':   self.process is not None,
+            'restarts':  max(0, self.starts-1),
+            'exit_code': self.exit_code,
+            'devices':   self.devices,
+        }
+
+# Run the devices in several worker processes (see '--workers').
+#
+# Each worker is a LeSyd process started with '--shard INDEX/COUNT' that only
+# manages its own devices with its own MQTT connections and scheduler. The
+# supervisor owns the bridge status topic (and its will), publishes the state
+# of the workers on 'lesyd/bridge/workers' and restarts the workers that exit
+# unexpectedly.
+class Supervisor():
+
+    # Interval between two checks of the worker processes (in seconds)
+    CHECK_INTERVAL = 1
+
+    # Delay before restarting a worker. It is doubled after each crash
+    # unless the worker was running for at least STABLE_DURATION.
+    MIN_RESTART_DELAY = 1
+    MAX_RESTART_DELAY = 300
+    STABLE_DURATION = 60
+
+    # Interval between two publications of the state of the workers (in seconds)
+    HEALTH_INTERVAL = 60
+
+    # Delay given to the workers to terminate (in seconds)
+    STOP_TIMEOUT = 10
+
+    def __init__(self, lesyd, argv:list, shards:list):
+        self.lesyd   = lesyd
+        self.logger  = lesyd.logger
+        self.argv    = argv
+        self.workers = [ WorkerProcess(index, names) for index, names in enumerate(shards) ]
+        self.topic_health = lesyd.name + '/bridge/workers'
+        self.health_time  = 0   # The time of the next periodic publication
+
+    def command(self, worker):
+        count = len(self.workers)
+        return [ sys.executable, os.path.abspath(__file__) ] + self.argv + [ '--shard', '{}/{}'.format(worker.index, count) ]
+
+    def start(self):
+        self.check()
+
+    def start_worker(self, worker, now):
+        # The workers are stopped by the supervisor so they must not receive
+        # the signals sent to the process group (e.g. Ctrl-C in a terminal).
+        worker.process = subprocess.Popen(self.command(worker), start_new_session=True)
+        worker.started = now
+        worker.starts += 1
+        self.logger.info("Worker %d started (pid %d) with %d devices",
+                         worker.index, worker.process.pid, len(worker.devices))
+
+    def check(self):
+        now = self.lesyd.clock()
+        changed = False
+        for worker in self.workers:
+            if worker.process:
+                code = worker.process.poll()
+                if code is None:
+                    if now - worker.started >= self.STABLE_DURATION:
+                        worker.restart_delay = self.MIN_RESTART_DELAY
+                    continue
+                self.logger.error("Worker %d (pid %d) exited with code %s. Restarting in %ds",
+                                  worker.index, worker.process.pid, code, worker.restart_delay)
+                worker.process = None
+                worker.exit_code = code
+                worker.restart_time = now + worker.restart_delay
+                worker.restart_delay = min(worker.restart_delay*2, self.MAX_RESTART_DELAY)
+                changed = True
+                self.publish_offline(worker)
+            if now >= worker.restart_time:
+                self.start_worker(worker, now)
+                changed = True
+
+        if changed or now >= self.health_time:
+            self.publish_health(now)
+            
+        self.lesyd.scheduler.schedule(self, now + self.CHECK_INTERVAL, self.check)
+
+    # The workers have no will so the status of the devices of a worker that
+    # exited is set here (the worker publishes 'online' again after its restart).
+    def publish_offline(self, worker):
+        client = self.lesyd.mqtt_client
+        if client.is_connected():
+            for name in worker.devices:
+                client.publish(self.lesyd.name + '/' + name + '/status', 'offline', retain=True)
+
+    def publish_health(self, now=None):
+        now = now or self.lesyd.clock()
+        self.health_time = now + self.HEALTH_INTERVAL
+        client = self.lesyd.mqtt_client
+        if client.is_connected():
+            workers = [ worker.health() for worker in self.workers ]
+            payload = json.dumps({
+                'count':   len(workers),
+                'running': sum(1 for w in workers if w['running']),
+                'workers': workers,
+            })
+            client.publish(self.topic_health, payload, retain=True)
+
+    def stop(self):
+        self.lesyd.scheduler.cancel(self)
+        running = [ worker for worker in self.workers if worker.process ]
+        for worker in running:
+            worker.process.send_signal(signal.SIGINT)
+        deadline = time.time() + self.STOP_TIMEOUT
+        for worker in running:
+            try:
+                worker.exit_code = worker.process.wait(max(0, deadline-time.time()))
+            except subprocess.TimeoutExpired:
+                self.logger.warning("Worker %d (pid %d) does not terminate. Killing it",
+                                    worker.index, worker.process.pid)
+                worker.process.kill()
+                worker.exit_code = worker.process.wait()
+            worker.process = None
+        self.publish_health()
 
 class LeSyd :
 
+    # The maximum number of events processed before checking the deadlines.
+    MAX_EVENT_BATCH = 100
+
+    # Interval between two logs of the event latency statistics (in seconds)
+    STATS_INTERVAL = 600
+
+    # The maximal number of events in the event queue (see EventQueue) 
+    EVENT_QUEUE_SIZE = 10000
+
+    # The responses of those functions are coalesced in the event queue.
+    COALESCED_FUNCTIONS = ( Device.FUNC_READ_HOLDING_REGISTERS, Device.FUNC_READ_INPUT_REGISTERS )
+
+    # Interval between two checks of the supervisor by a worker (in seconds)
+    PARENT_CHECK_INTERVAL = 5
+
+    # Interval between two flushes of the capture file (in seconds)
+    CAPTURE_FLUSH_INTERVAL = 1
+
     # args is typically a 'argparse.Namespace' object but any object with 
     # the following attributes will do (or use setattr(args, NAME, VALUE) to
     # manually set attributes).
@@ -1319,7 +3249,11 @@ class LeSyd :
     #  - args.mqtt_username   (str|None)  The MQTT username
     #  - args.mqtt_password   (str|None)  The MQTT password
     #
-    def __init__(self) :
+    # 'clock' is the function that provides the current time (e.g. a ManualClock).
+    #
+    def __init__(self, argv=None, clock=time.time) :
+
+        self.clock = clock
 
 
         default_log_fmt       = "[%(levelname)s] %(name)s: %(message)s"
@@ -1353,6 +3287,37 @@ class LeSyd :
                             help="Set the log level. Default is INFO"
                             )
 
+        parser.add_argument('--engine',
+                            choices=['threads','asyncio'],
+                            default='threads',
+                            help="Select how the MQTT events are processed. Default is threads"
+                            )
+
+        parser.add_argument('--workers',
+                            type=int,
+                            default=None,
+                            help="Distribute the devices over that number of worker processes"
+                            )
+
+        parser.add_argument('--shard',
+                            default=None,
+                            help="Internal: run as the worker INDEX/COUNT started by --workers"
+                            )
+
+        parser.add_argument('--capture',
+                            default=None,
+                            help="Append all Sydpower frames to the specified capture file"
+                            )
+
+        parser.add_argument('--replay',
+                            default=None,
+                            help="Process the Sydpower frames of a capture file and quit"
+                            )
+
+        parser.add_argument('--replay-realtime', action='store_true',
+                            help="Replay the capture file at its original speed instead of as fast as possible"
+                            )
+
         parser.add_argument('--print-sample-config', action='store_true',
                      help="print a sample configuration file and quit")
         parser.add_argument('--list-presets', action='store_true',
@@ -1360,7 +3325,10 @@ class LeSyd :
         parser.add_argument('--print-default-logconfig', action='store_true',
                      help="print the default logging configuration file")
         
-        args=parser.parse_args()
+        args=parser.parse_args(argv)
+
+        # The arguments are also given to the worker processes.
+        self.argv = list(sys.argv[1:] if argv is None else argv)
 
         if args.print_sample_config:
             print( YAML_SAMPLES[0] )
@@ -1396,6 +3364,9 @@ class LeSyd :
             'loglevel'     : 'INFO',
             'ha_discovery' : False,
             'ha_prefix'    : 'homeassistant',
+            'workers'      : 0,
+            'history_raw_hours'   : 24,
+            'history_minute_days' : 30,
         }
         global_config.update( config.get('global',None) or {} )
         
@@ -1447,6 +3418,17 @@ class LeSyd :
             self.mqtt_sydpower_config = None
             self.logger.info("MQTT SYDPOWER is MQTT CLIENT")
 
+        ### Replay of a capture file (see replay())
+
+        self.replay_path     = args.replay
+        self.replay_realtime = args.replay_realtime
+        if self.replay_path:
+            # The devices are fed from the capture file at the time of each
+            # frame and their publications are discarded.
+            self.clock = ManualClock()
+            self.mqtt_client_config = { 'transport': 'memory', 'hostname': 'replay', 'port': 0, 'will': True }
+            self.mqtt_sydpower_config = None
+
         ### 'homeassistant' section of configuration file
 
         self.ha_discovery = global_config['ha_discovery']
@@ -1466,18 +3448,125 @@ class LeSyd :
                       
         ### 'devices' section of configuration file
         
+        self.scheduler = Scheduler()
         self.devices = [] 
         for mac in config['devices'].keys():
             dev = Device(self, mac, config) 
             self.devices.append(dev)                
                 
-        self.message_handlers = {} 
-        self.tic_interval = 0.2   # minimal interval in seconds between two tics 
-        self._last_tic_time = time.time()   # When self.on_tic was last called
-        self.event_queue = queue.Queue()    
+        self.engine = args.engine
+        workers = global_config['workers']
+        if args.workers is not None:
+            workers = args.workers
+        if self.replay_path:
+            workers = 1
+
+        for dev in self.devices:
+            if dev.worker is not None and dev.worker >= workers > 1 and args.shard is None:
+                self.logger.error("Device '%s': worker %d does not exist (%d workers)",
+                                  dev.name, dev.worker, workers)
+                sys.exit(1)
+
+        self.shard = None
+        self.supervisor = None
+        if args.shard:
+            # A worker process only manages its own devices.
+            try:
+                index, count = ( int(x) for x in args.shard.split('/') )
+            except ValueError:
+                self.logger.error("Malformed shard '%s'", args.shard)
+                sys.exit(1)
+            self.shard = (index, count)
+            self.parent_pid = os.getppid()
+            self.devices = [ dev for dev in self.devices if device_worker(dev, count) == index ]
+            # The will is owned by the supervisor.
+            del self.mqtt_client_config['will']
+            self.logger.info("Worker %d/%d with %d devices", index, count, len(self.devices))
+        elif workers > 1:
+            shards = [ [] for i in range(workers) ]
+            for dev in self.devices:
+                shards[device_worker(dev, workers)].append(dev.name)
+            self.supervisor = Supervisor(self, self.argv, shards)
+            self.devices = []
+
+        capture = global_config.get('capture')
+        if args.capture is not None:
+            capture = args.capture
+        self.capture = None
+        if capture and not self.replay_path and not self.supervisor:
+            if self.shard:
+                # Each worker has its own capture file.
+                capture = "{}.{}".format(capture, self.shard[0])
+            try:
+                self.capture = CaptureWriter(capture)
+            except OSError as err:
+                self.logger.error("Cannot open capture file: %s", err)
+                sys.exit(1)
+            self.logger.info("Capture of the Sydpower frames in '%s'", capture)
+
+        self.history = None
+        history = global_config.get('history')
+        if history and not self.replay_path and not self.supervisor:
+            # The workers share the same database.
+            try:
+                self.history = HistoryStore(history,
+                                            global_config['history_raw_hours'] * 3600,
+                                            global_config['history_minute_days'] * 86400,
+                                            self.clock)
+            except (OSError, sqlite3.Error) as err:
+                self.logger.error("Cannot open history database '%s': %s", history, err)
+                sys.exit(1)
+            self.logger.info("History of the state fields in '%s'", history)
+
+        self.event_queue = EventQueue(self.EVENT_QUEUE_SIZE)    
+        self.post_event  = self.event_queue.put
+        self.event_latency = LatencyStats()
+        self.event_handlers = {
+            'message':      self.on_message,
+            'connect_fail': self.on_connect_fail,
+            'connect':      self.on_connect,
+            'disconnect':   self.on_disconnect,
+            'signal':       self.on_signal,
+            'history':      self.on_history,
+        }
         self.result = None   # Setting this to any value will stop the loop()      
         self.will_topic = self.name + '/bridge/status'
 
+        # A single set of wildcard subscriptions is used for all devices.
+        self.sydpower_subscriptions = [ '+/device/response/#' ]
+        self.client_subscriptions   = [ self.name + '/+/state/set/+',
+                                        self.name + '/+/status' ]
+        if self.history:
+            self.client_subscriptions.append(self.name + '/+/history/get')
+        if self.shard:
+            # The other devices are managed by the other workers.
+            self.sydpower_subscriptions = [ dev.mac.upper() + '/device/response/#' for dev in self.devices ]
+            self.client_subscriptions = []
+            for dev in self.devices:
+                self.client_subscriptions += [ dev.topic_command + '+', dev.topic_status ]
+                if self.history:
+                    self.client_subscriptions.append(dev.topic_history_get)
+        elif self.supervisor:
+            self.sydpower_subscriptions = []
+            self.client_subscriptions   = []
+
+        # The handlers of all known topics received via the wildcard subscriptions.
+        self.devices_by_name  = { dev.name: dev for dev in self.devices }
+        self.message_handlers = {} 
+        self.response_topics  = set()
+        self.command_prefix   = self.name + '/'
+        self.message_handlers[self.will_topic] = self.process_will_msg
+        for dev in self.devices:
+            self.message_handlers[dev.topic_response_04]    = dev.process_sydpower_response
+            self.message_handlers[dev.topic_response]       = dev.process_sydpower_response
+            self.response_topics.update([ dev.topic_response_04, dev.topic_response ])
+            self.message_handlers[dev.topic_response_state] = dev.process_sydpower_state
+            self.message_handlers[dev.topic_status]         = dev.process_status_msg
+            for command in dev.command_handlers:
+                self.message_handlers[dev.topic_command+command] = dev.process_command
+            if self.history:
+                self.message_handlers[dev.topic_history_get] = dev.process_history_get
+
     def find_device_by_name(self, name):
         for dev in self.devices:
             if dev.name == name:
@@ -1528,9 +3617,7 @@ class LeSyd :
 
         transport = config['transport']
 
-        if transport=='tcp':
-            pass
-        else:
+        if transport != 'memory' and transport not in PAHO_TRANSPORTS:
             self.logger.error("Sorry! Transport '%s' is not yet implemented", transport)
             sys.exit(1)
 
@@ -1570,7 +3657,7 @@ class LeSyd :
             
         if 'username' in config:
             client.username_pw_set(config['username'], config['password'])
-                      
+
         client.on_connect      = self._on_connect_cb
         client.on_connect_fail = self._on_connect_fail_cb
         client.on_disconnect   = self._on_disconnect_cb
@@ -1583,7 +3670,6 @@ class LeSyd :
         client.connect_async(config['hostname'],
                              config['port'],
                              keepalive=60)
-        client.loop_start()
         
         
 
@@ -1622,14 +3708,14 @@ class LeSyd :
         return config
 
     def _on_connect_fail_cb(self, client, userdata):    
-        self.event_queue.put( ['connect_fail', client, userdata ] )
+        self.post_event( Event('connect_fail', (client, userdata)) )
         
     def _on_connect_cb(self, client, userdata, flags, reason_code, properties):
-        self.event_queue.put( ['connect', client, userdata, flags, reason_code, properties ] )
+        self.post_event( Event('connect', (client, userdata, flags, reason_code, properties)) )
 
     def _on_disconnect_cb(self, client, userdata, flags, reason_code, properties):
         # print('_on_disconnect_cb')
-        self.event_queue.put( ['disconnect', client, userdata, flags, reason_code, properties ] )
+        self.post_event( Event('disconnect', (client, userdata, flags, reason_code, properties)) )
         #if client == self.mqtt_client:
         #   print(self.will_topic, "OFFLINE")
         #   self.mqtt_client.publish(self.will_topic,'offline')
@@ -1637,7 +3723,26 @@ class LeSyd :
     
             
     def _on_message_cb(self, client, userdata, msg):
-        self.event_queue.put( ['message', client, userdata, msg ] )
+        key, droppable = self.message_policy(msg)
+        self.post_event( Event('message', (client, userdata, msg), key, droppable) )
+
+    # Return the key and the droppable flag of the event of a MQTT message
+    # (see EventQueue). This is called by the MQTT threads.
+    #
+    #  - The register dumps of a device are only useful until the next one
+    #    so they are coalesced per device and per register range.
+    #  - The commands are never dropped.
+    #  - The other messages can be dropped when the queue is full.
+    def message_policy(self, msg):
+        topic = msg.topic
+        if topic in self.response_topics:
+            payload = msg.payload
+            if len(payload) >= 6 and payload[1] in self.COALESCED_FUNCTIONS:
+                return (topic, payload[1:6]), True
+            return None, True
+        if topic.startswith(self.command_prefix) and '/state/set/' in topic:
+            return None, False
+        return None, True
 
     def _on_subscribe_cb(self, client, userdata, mid, reason_code_list, properties):
         # TODO 
@@ -1661,18 +3766,39 @@ class LeSyd :
     # 
     # TODO: Check for success in on_subscribe_cb
     #
-    def subscribe(self, client, topic, handler, qos=0):
+    def subscribe(self, client, topic, qos=0):
         self.logger.info("Subscribe to '%s'",topic)
         sid = client.subscribe(topic, qos=0)
-        self.message_handlers[topic] = handler 
         return sid
 
+    # Our own 'lesyd/bridge/status' is also received via 'lesyd/+/status'
+    def process_will_msg(self, msg):
+        pass
+    
     def on_message(self, client, userdata, msg):
+        if self.capture and '/device/response/' in msg.topic:
+            self.capture.record(CAPTURE_INBOUND, msg.topic, msg.payload, self.clock())
+            
         handler = self.message_handlers.get(msg.topic)        
         if handler: 
             handler(msg)
-        else:
-            self.logger.warning("Unknown topic '%s'",msg.topic) 
+            return
+
+        # Unknown commands are reported by the device.
+        levels = msg.topic.split('/')
+        if len(levels)==5 and levels[0]==self.name and levels[2]=='state' and levels[3]=='set':
+            dev = self.devices_by_name.get(levels[1])
+            if dev:
+                dev.process_command(msg)
+                return
+
+        # The wildcard subscriptions also provide messages for devices
+        # that are not managed by LeSyd. 
+        self.logger.debug("Ignoring topic '%s'",msg.topic) 
+
+    # The response to a history query (from the history thread)
+    def on_history(self, dev, response):
+        self.mqtt_client.publish(dev.topic_history_response, json.dumps(response))
 
     # Called when the connection cannot be established (i.e. nobody
     # is listening there)
@@ -1688,42 +3814,32 @@ class LeSyd :
             return 
         
         if client == self.mqtt_sydpower:            
-            for dev in self.devices:
-                self.subscribe( self.mqtt_sydpower, dev.topic_response_04 , dev.process_sydpower_response)
-                self.subscribe( self.mqtt_sydpower, dev.topic_response,     dev.process_sydpower_response)
-                self.subscribe( self.mqtt_sydpower, dev.topic_response_state, dev.process_sydpower_state)
+            for topic in self.sydpower_subscriptions:
+                self.subscribe( self.mqtt_sydpower, topic )
 
         if client == self.mqtt_client:
 
-            self.mqtt_client.publish(self.will_topic, 'online', retain=True)
+            if self.shard is None:
+                self.mqtt_client.publish(self.will_topic, 'online', retain=True)
+
+            if self.supervisor:
+                self.supervisor.publish_health()
 
             #if self.ha_discovery:
             #    homeassistant_discovery_bridge(self, self.mqtt_client)
+
+            for topic in self.client_subscriptions:
+                self.subscribe( self.mqtt_client, topic )
     
             for dev in self.devices:
-                for command in [ '/set/ac_output' ,
-                                 '/set/usb_output',
-                                 '/set/dc_output',
-                                 '/set/key_sound',
-                                 '/set/ac_silent_charging',
-                                 '/set/ac_booking_charging',
-                                 '/set/dc_max_charging_current',
-                                 '/set/led',                      
-                                 '/set/key_sound',                      
-                                 '/set/discharge_lower_limit', 
-                                 '/set/ac_charging_upper_limit',
-                                 '/set/ac_mode', 
-                                ] :
-                    self.subscribe( self.mqtt_client, dev.topic_state+command , dev.process_command )                
-
                 if self.ha_discovery:
                     homeassistant_discovery_device(self, dev, self.mqtt_client)
 
-                self.subscribe( self.mqtt_client, dev.topic_status , dev.process_status_msg )                
-
                 dev.set_status('offline')
-                
-                
+
+        # Some deadlines are ignored while disconnected.
+        for dev in self.devices:
+            dev.wake()
                 
     def on_disconnect(self, client, userdata, flags, reason_code, properties):
         # TODO
@@ -1735,75 +3851,200 @@ class LeSyd :
         self.logger.info("Signal %s",num)
         self.graceful_shutdown(1)
     
-    def on_tic(self): 
-        for dev in self.devices:
-            dev.on_tic(self)
-            
-    def loop(self) :
-
+    # Create a new MQTT client for the transport of a mqtt configuration
+    def new_mqtt_client(self, config):
+        transport = config['transport']
+        if transport == 'memory':
+            return memory_broker(config['hostname']).client()
+        return mqtt.Client(mqtt.CallbackAPIVersion.VERSION2,
+                           transport=PAHO_TRANSPORTS.get(transport, transport))
+    
+    def create_mqtt_clients(self):
         
-        self.mqtt_client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)        
+        self.mqtt_client = self.new_mqtt_client(self.mqtt_client_config)
         self.start_mqtt_client( self.mqtt_client, self.mqtt_client_config )
+        self.mqtt_clients = [ self.mqtt_client ]
     
         if self.mqtt_sydpower_config is None:
             self.mqtt_sydpower = self.mqtt_client
         else:            
-            self.mqtt_sydpower = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+            self.mqtt_sydpower = self.new_mqtt_client(self.mqtt_sydpower_config)
             self.start_mqtt_client( self.mqtt_sydpower, self.mqtt_sydpower_config )
-            
-        signal.signal(signal.SIGINT, self.signal_handler)
+            self.mqtt_clients.append( self.mqtt_sydpower )
+
+    def process_event(self, event):
+        self.event_latency.add(time.perf_counter() - event.time)
+        handler = self.event_handlers.get(event.kind)
+        if handler:
+            handler(*event.args)
+        else:
+            self.logger.warning('Warning: Unexpected event kind %s', event.kind)
         
-        timeout = max(0.1,self.tic_interval)
-        while True:
-            try:
-                event = self.event_queue.get(True, timeout) 
-                if event[0] == 'message' :
-                    self.on_message(*event[1:])
-                elif event[0] == 'connect_fail' :
-                    self.on_connect_fail(*event[1:]) 
-                elif event[0] == 'connect' :
-                    self.on_connect(*event[1:]) 
-                elif event[0] == 'disconnect' :
-                    self.on_disconnect(*event[1:]) 
-                elif event[0] == 'signal' :                
-                    self.on_signal(*event[1:]) 
-                else:
-                    self.logger.warning('Warning: Unexpected event kind %s', kind)
-            except queue.Empty as err:
-                pass
-            except queue.Full as err:
-                self.logger.error("%s",repr(err))            
+    # Connect and start the devices (for the default engine).
+    def start(self):
+        
+        self.create_mqtt_clients()
+        for client in self.mqtt_clients:
+            client.loop_start()
+
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGINT, self.signal_handler)
+            signal.set_wakeup_fd(self.event_queue.wakeup_fd())
+
+        self.start_services()
+
+    # Start the periodic tasks and the devices (for all engines).
+    def start_services(self):
+        self.schedule_log_stats()
+        if self.supervisor:
+            self.supervisor.start()
+        if self.shard:
+            self.check_parent()
+        if self.capture:
+            self.flush_capture()
+        if self.history:
+            self.history.start()
+        
+        for dev in self.devices:
+            dev.wake()
 
-            if not self.result is None:
+    # Wait for an event or a deadline, then process them.
+    def step(self, timeout):
+        
+        self.event_queue.wait(timeout)
+
+        # Process the pending events but do not delay the deadlines for too long. 
+        for i in range(self.MAX_EVENT_BATCH):
+            event = self.event_queue.get()
+            if event is None:
                 break
+            self.process_event(event)
+            if not self.result is None:
+                return
                 
-            now = time.time()
-            next_tic = self._last_tic_time + self.tic_interval 
-            if now >= next_tic: 
-                self._last_tic_time = now 
-                self.on_tic()
-                timeout = max(0.1, self.tic_interval)
-            else:
-                timeout = max(0.1 ,next_tic-now)
+        self.scheduler.run_due(self.clock())
+
+    # Process all events and deadlines until the clock reaches 'when' without 
+    # waiting. This is only meaningful with a ManualClock that is advanced to
+    # each deadline.
+    def run_until(self, when):
+        while self.result is None:
+            if len(self.event_queue) == 0:
+                deadline = self.scheduler.next_deadline()
+                if deadline is None or deadline > when:
+                    break
+                self.clock.set(deadline)
+            self.step(0)
+        self.clock.set(when)
+        
+    # Feed the inbound Sydpower frames of a capture file to the devices (see '--replay')
+    def replay(self):
+        try:
+            reader = CaptureReader(self.replay_path)
+        except (OSError, ValueError) as err:
+            self.logger.error("%s", err)
+            sys.exit(1)
 
+        frames  = 0
+        skipped = 0
+        first   = None
+        start   = time.perf_counter()
+        for when, direction, topic, payload in reader:
+            if direction != CAPTURE_INBOUND:
+                # The requests are produced again by the devices.
+                skipped += 1
+                continue
+            if first is None:
+                first = when
+                self.clock.set(when)
+                self.start()
+            if self.replay_realtime:
+                delay = (when - first) - (time.perf_counter() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            self.run_until(when)
             if not self.result is None:
                 break
+            self.on_message(None, None, MemoryMessage(topic, payload))
+            frames += 1
+        elapsed = time.perf_counter() - start
+
+        if reader.truncated:
+            self.logger.warning("The last record of '%s' is truncated", self.replay_path)
+        reader.close()
+
+        print("Replayed {} frames ({} requests skipped) in {:.3f}s: {:.0f} frames/s".format(
+            frames, skipped, elapsed, frames/elapsed if elapsed > 0 else 0))
+        if first is not None:
+            self.graceful_shutdown(0)
+        sys.exit(0)
+
+    def loop(self) :
+
+        if self.replay_path:
+            return self.replay()
+
+        if self.engine == 'asyncio':
+            return AsyncioEngine(self).run()
+
+        self.start()
+        
+        while self.result is None:
+            # Sleep until the next event or the earliest deadline.
+            self.step(self.scheduler.timeout(self.clock()))
 
         self.graceful_shutdown(0)
         return self.result
 
+    def schedule_log_stats(self):
+        self.scheduler.schedule(self.event_latency, self.clock()+self.STATS_INTERVAL, self.log_stats)
+
+    # A worker terminates when its supervisor is gone.
+    def check_parent(self):
+        if os.getppid() != self.parent_pid:
+            self.logger.error("The supervisor is gone")
+            self.graceful_shutdown(1)
+        self.scheduler.schedule(self.check_parent, self.clock()+self.PARENT_CHECK_INTERVAL, self.check_parent)
+
+    def flush_capture(self):
+        self.capture.flush()
+        self.scheduler.schedule(self.capture, self.clock()+self.CAPTURE_FLUSH_INTERVAL, self.flush_capture)
+
+    def log_stats(self):
+        self.logger.debug("Event latency: %s", self.event_latency)
+        self.logger.debug("Event queue: %s", self.event_queue)
+        if self.history:
+            self.logger.debug("History: %s", self.history)
+        self.event_latency.reset()
+        self.schedule_log_stats()
+
     def graceful_shutdown(self,code):
-        if self.mqtt_client.is_connected() :
+        self.logger.info("Event latency: %s", self.event_latency)
+        self.logger.info("Event queue: %s", self.event_queue)
+        if self.supervisor:
+            self.supervisor.stop()
+        if self.capture:
+            self.logger.info("%d frames captured in '%s'", self.capture.records, self.capture.path)
+            self.capture.close()
+        if self.history:
+            self.history.stop()
+            self.logger.info("History: %s", self.history)
+        if self.mqtt_client.is_connected() and self.shard is None:
             mid = self.mqtt_client.publish(self.will_topic,'offline', qos=0, retain=True)
-            mid.wait_for_publish()
+            if self.engine == 'asyncio':
+                # No thread is running the network loop
+                self.mqtt_client.loop_write()
+            else:
+                mid.wait_for_publish()
         self.mqtt_client.disconnect()
-        self.mqtt_client.loop_stop()
-        if self.mqtt_client != self.mqtt_sydpower:
-            self.mqtt_sydpower.loop_stop()        
+        if self.engine == 'asyncio':
+            self.mqtt_client.loop_write()
+        for client in self.mqtt_clients:
+            client.loop_stop()
         sys.exit(code)
 
     def signal_handler(self, signum, frame):
-        self.event_queue.put( ["signal", signum] )
+        self.post_event( Event('signal', (signum,)) )
         
 if __name__ == "__main__":
 
@@ -0,0 +1,213 @@
+#!/usr/bin/python3
+#
+# Batch decoding of captured ReadInputRegisters responses for offline analysis.
+#
+# Feeding months of captured frames one by one to the devices is far too
+# slow. Here, the frames are stacked in a numpy matrix (one row per frame)
+# so the CRCs are validated and the 80 input registers are unpacked for all
+# frames at once. The RegisterField definitions of INPUT_REGISTER_MAP are
+# then applied as column operations and the result is a dict of columns
+# that can be exported to CSV or to Parquet (if 'pyarrow' is installed).
+#
+# Decode a capture file recorded with 'lesyd.py --capture FILE':
+#
+#   python3 lesyd_batch.py capture.bin --csv capture.csv
+#   python3 lesyd_batch.py capture.bin --parquet capture.parquet
+#
+# Only the responses to a read of all input registers (the usual poll) are
+# decoded. The other frames are counted as skipped.
+#
+
+import sys
+import csv
+import time
+import struct
+import argparse
+
+import numpy as np
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+import lesyd
+
+REGISTER_COUNT = 80
+
+# Channel, function, first register, register count, registers and CRC
+FRAME_HEADER = 6
+FRAME_SIZE   = FRAME_HEADER + 2*REGISTER_COUNT + 2
+
+MODBUS_CHANNEL            = lesyd.Device.MODBUS_CHANNEL
+FUNC_READ_INPUT_REGISTERS = lesyd.Device.FUNC_READ_INPUT_REGISTERS
+
+CRC16_TABLE = np.array(lesyd.MODBUS_CRC16_TABLE, dtype=np.uint16)
+
+# Vectorized versions of the 'combine' functions of INPUT_REGISTER_MAP.
+#
+# The combine functions of the register maps work on python integers. The
+# fields without an entry here fall back to calling them once per frame.
+COLUMN_COMBINE = {
+    'ac_input_power': lambda total, dc: np.maximum(0, total.astype(np.int32) - dc),
+}
+
+# The function, first register and register count of the responses to a
+# read of all input registers.
+FRAME_PREFIX = struct.pack('>BHH', FUNC_READ_INPUT_REGISTERS, 0, REGISTER_COUNT)
+
+# Stack the frames in a (N,FRAME_SIZE) uint8 matrix.
+#
+# The frames that are not a response to a read of all input registers are
+# ignored. Return the matrix and the indices of the frames it contains.
+def stack_frames(frames) -> tuple:
+    index = [ i for i, frame in enumerate(frames)
+              if len(frame) == FRAME_SIZE and frame[1:FRAME_HEADER] == FRAME_PREFIX ]
+    data = b''.join( bytes(frames[i]) for i in index )
+    matrix = np.frombuffer(data, dtype=np.uint8).reshape(len(index), FRAME_SIZE)
+    return matrix, np.array(index, dtype=np.int64)
+
+# The Modbus CRC16 of the first 'size' bytes of all rows of 'matrix'.
+#
+# The table driven algorithm of modbus_crc16_table is applied column by
+# column, so the python loop runs once per byte position instead of once
+# per byte.
+def crc16_rows(matrix, size:int):
+    table = CRC16_TABLE
+    crc = np.full(matrix.shape[0], 0xFFFF, dtype=np.uint16)
+    for col in range(size):
+        crc = (crc >> 8) ^ table[(crc ^ matrix[:, col]) & 0xFF]
+    return crc
+
+# A boolean column that is True for the rows with a valid channel and CRC.
+def valid_rows(matrix):
+    crc = (matrix[:, -2].astype(np.uint16) << 8) | matrix[:, -1]
+    return (matrix[:, 0] == MODBUS_CHANNEL) & (crc16_rows(matrix, FRAME_SIZE-2) == crc)
+
+# Unpack the big-endian registers of all rows into a (N,REGISTER_COUNT) uint16 matrix.
+def unpack_registers(matrix):
+    data = np.ascontiguousarray(matrix[:, FRAME_HEADER:FRAME_HEADER+2*REGISTER_COUNT])
+    return data.view('>u2').astype(np.uint16)
+
+# Compute the column of a RegisterField from the register matrix.
+#
+# This is the column equivalent of RegisterField.compile()
+def field_column(field:lesyd.RegisterField, registers):
+    columns = [ registers[:, r] for r in field.regs ]
+    combine = COLUMN_COMBINE.get(field.field)
+    if combine:
+        col = combine(*columns)
+    elif field.combine:
+        col = np.frompyfunc(field.combine, len(columns), 1)(*[ c.astype(np.int64) for c in columns ])
+        col = col.astype(np.int64)
+    elif len(columns) == 1:
+        col = columns[0]
+    else:
+        # The sum of several uint16 may not fit in 16 bits
+        col = np.sum(columns, axis=0, dtype=np.int64)
+
+    if field.mask is not None:
+        col = col & field.mask
+    if field.divisor is not None:
+        col = col / field.divisor
+    if field.convert is bool:
+        col = col != 0
+    elif field.convert is not None:
+        col = np.frompyfunc(field.convert, 1, 1)(col)
+    if field.choices is not None:
+        col = np.array(field.choices, dtype=object)[col]
+    return col
+
+# Decode the frames and return a dict of columns (one per field).
+#
+# The 'valid' column tells which frames passed the checks. The fields of
+# the invalid frames are meaningless and should be filtered out with
+# 'drop_invalid'.
+def decode_frames(frames, fields=lesyd.INPUT_REGISTER_MAP) -> dict:
+    matrix, index = stack_frames(frames)
+    registers = unpack_registers(matrix)
+    columns = { 'index': index, 'valid': valid_rows(matrix) }
+    for field in fields:
+        columns[field.field] = field_column(field, registers)
+    return columns
+
+# Keep only the rows of the valid frames (and remove the 'valid' column).
+def drop_invalid(columns:dict) -> dict:
+    valid = columns['valid']
+    return { name: col[valid] for name, col in columns.items() if name != 'valid' }
+
+# Decode the ReadInputRegisters responses of a capture file.
+#
+# The columns are completed with the 'time' and 'mac' of each frame. Return
+# the columns and the number of inbound frames that were not decoded.
+def decode_capture(path:str, fields=lesyd.INPUT_REGISTER_MAP) -> tuple:
+    reader = lesyd.CaptureReader(path)
+    times  = []
+    macs   = []
+    frames = []
+    for when, direction, topic, payload in reader:
+        if direction == lesyd.CAPTURE_INBOUND:
+            times.append(when)
+            macs.append(topic.split('/', 1)[0])
+            frames.append(payload)
+    columns = decode_frames(frames, fields)
+    reader.close()
+    index = columns['index']
+    columns['time'] = np.array(times, dtype=np.float64)[index]
+    columns['mac']  = np.array(macs, dtype=object)[index]
+    return columns, len(frames) - len(index)
+
+# The columns in export order: time and mac first, then the fields.
+def export_columns(columns:dict) -> list:
+    first = [ name for name in ('time', 'mac') if name in columns ]
+    return first + [ name for name, col in columns.items()
+                     if name not in first and name != 'index' ]
+
+def write_csv(columns:dict, path:str):
+    names = export_columns(columns)
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(names)
+        writer.writerows(zip(*[ columns[name].tolist() for name in names ]))
+
+def write_parquet(columns:dict, path:str):
+    if pyarrow is None:
+        raise RuntimeError("Parquet export requires the 'pyarrow' package")
+    names = export_columns(columns)
+    table = pyarrow.table({ name: columns[name] for name in names })
+    pyarrow.parquet.write_table(table, path)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Decode the register responses of a LeSyd capture file")
+    parser.add_argument('capture', help="A capture file recorded with 'lesyd.py --capture'")
+    parser.add_argument('--csv', default=None, help="Write the decoded fields to that CSV file")
+    parser.add_argument('--parquet', default=None, help="Write the decoded fields to that Parquet file")
+    parser.add_argument('--keep-invalid', action='store_true',
+                        help="Keep the frames with a bad CRC or header (see the 'valid' column)")
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    try:
+        columns, skipped = decode_capture(args.capture)
+    except (OSError, ValueError) as err:
+        print(err, file=sys.stderr)
+        sys.exit(1)
+    total = len(columns['index'])
+    invalid = total - int(np.count_nonzero(columns['valid']))
+    if not args.keep_invalid:
+        columns = drop_invalid(columns)
+    elapsed = time.perf_counter() - start
+    print("Decoded {} frames ({} invalid, {} skipped) in {:.3f}s".format(total, invalid, skipped, elapsed))
+
+    if args.csv:
+        write_csv(columns, args.csv)
+    if args.parquet:
+        try:
+            write_parquet(columns, args.parquet)
+        except RuntimeError as err:
+            print(err, file=sys.stderr)
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,340 @@
+#!/usr/bin/python3
+#
+# A simulator of Sydpower stations (Fossibot, ...) for load testing LeSyd.
+#
+# Each simulated station answers the Modbus requests published by LeSyd on
+# 'MAC/client/request/data' with CRC-valid responses on
+# 'MAC/device/response/client/data'. The state of charge and the powers
+# drift over time and the writes of the holding registers are applied to
+# the registers.
+#
+# Start 1000 stations on the local MQTT server:
+#
+#   python3 lesyd_sim.py --count 1000 --latency 0.05 --loss 0.01
+#
+# and print the 'devices' section of the matching LeSyd configuration:
+#
+#   python3 lesyd_sim.py --count 1000 --print-devices
+#
+
+import sys
+import time
+import heapq
+import random
+import struct
+import logging
+import argparse
+import threading
+
+import lesyd
+from lesyd import ( IREG_AC_CHARGING_RATE, IREG_AC_CHARGING_POWER, IREG_DC_CHARGING_POWER,
+                    IREG_TOTAL_INPUT_POWER, IREG_DC_OUTPUT_POWER_1, IREG_LED_POWER,
+                    IREG_AC_OUTPUT_VOLTAGE, IREG_AC_OUTPUT_FREQUENCY, IREG_AC_OUTPUT_POWER,
+                    IREG_AC_INPUT_VOLTAGE, IREG_AC_INPUT_FREQUENCY, IREG_LED_STATE,
+                    IREG_USB_OUTPUT_POWER_1, IREG_USB_OUTPUT_POWER_2, IREG_STATUS_BITS,
+                    IREG_STATE_OF_CHARGE_1, IREG_STATE_OF_CHARGE_2, IREG_STATE_OF_CHARGE,
+                    IREG_AC_BOOKING_CHARGING, IREG_TIME_TO_FULL, IREG_TIME_TO_EMPTY,
+                    HREG_AC_CHARGING_RATE, HREG_DC_MAX_CHARGING_CURRENT, HREG_USB_OUTPUT,
+                    HREG_DC_OUTPUT, HREG_AC_OUTPUT, HREG_LED, HREG_KEY_SOUND,
+                    HREG_AC_BOOKING_CHARGING,
+                    HREG_DISCHARGE_LOWER_LIMIT, HREG_AC_CHARGING_UPPER_LIMIT )
+
+REGISTER_COUNT = 80
+
+MODBUS_CHANNEL = lesyd.Device.MODBUS_CHANNEL
+FUNC_READ_HOLDING_REGISTERS = lesyd.Device.FUNC_READ_HOLDING_REGISTERS
+FUNC_READ_INPUT_REGISTERS   = lesyd.Device.FUNC_READ_INPUT_REGISTERS
+FUNC_WRITE_HOLDING_REGISTER = lesyd.Device.FUNC_WRITE_HOLDING_REGISTER
+
+# Modbus exception codes
+ILLEGAL_FUNCTION     = 1
+ILLEGAL_DATA_ADDRESS = 2
+
+# The bits of IREG_STATUS_BITS that reflect the holding registers of the outputs.
+OUTPUT_STATUS_BITS = {
+    HREG_AC_OUTPUT:  1<<11,
+    HREG_DC_OUTPUT:  1<<10,
+    HREG_USB_OUTPUT: 1<<9,
+}
+
+def modbus_frame(payload:bytes) -> bytes:
+    return payload + lesyd.modbus_crc16(payload, len(payload)).to_bytes(2, 'big')
+
+def modbus_exception(func:int, code:int) -> bytes:
+    return modbus_frame(bytes([MODBUS_CHANNEL, func | 0x80, code]))
+
+# A simulated station.
+#
+# The registers are only updated when a request is received so thousands
+# of idle stations cost nothing.
+class SimulatedStation():
+
+    # The capacity of the battery in Wh
+    CAPACITY = 2048
+
+    def __init__(self, mac:str, seed=None):
+        self.mac    = mac.lower()
+        # Each station has its own sequence, reproducible for a given seed.
+        self.random = random.Random(self.mac if seed is None else "{}/{}".format(seed, self.mac))
+        MAC = self.mac.upper()
+        self.topic_request  = MAC + '/client/request/data'
+        self.topic_response = MAC + '/device/response/client/data'
+
+        rnd = self.random
+        self.input   = [0] * REGISTER_COUNT
+        self.holding = [0] * REGISTER_COUNT
+        self.soc = rnd.uniform(20, 100)          # in %
+        self.ac_output_power = rnd.uniform(0, 300)
+        self.ac_charging_power = 0.0
+        self.dc_charging_power = rnd.choice([0.0, rnd.uniform(50, 200)])
+        self.last_update = None
+
+        holding = self.holding
+        holding[HREG_AC_CHARGING_RATE] = 3
+        holding[HREG_DC_MAX_CHARGING_CURRENT] = 8
+        holding[HREG_AC_OUTPUT]  = 1
+        holding[HREG_DC_OUTPUT]  = rnd.randrange(2)
+        holding[HREG_USB_OUTPUT] = rnd.randrange(2)
+        holding[HREG_KEY_SOUND]  = 1
+        holding[HREG_DISCHARGE_LOWER_LIMIT]   = 100
+        holding[HREG_AC_CHARGING_UPPER_LIMIT] = 1000
+
+        self.input[IREG_AC_OUTPUT_VOLTAGE]   = 2300
+        self.input[IREG_AC_OUTPUT_FREQUENCY] = 500
+        self.update(time.time())
+
+    # Let the state drift until 'now' and update the input registers.
+    def update(self, now:float):
+        if self.last_update is not None:
+            dt = max(0.0, now - self.last_update)
+            rnd = self.random
+            holding = self.holding
+
+            if holding[HREG_AC_OUTPUT]:
+                self.ac_output_power += rnd.gauss(0, 20) * min(dt, 10)
+                self.ac_output_power = min(max(self.ac_output_power, 0), 2000)
+            else:
+                self.ac_output_power = 0
+
+            # Charge with AC when the battery is low, until the upper limit.
+            limit = holding[HREG_AC_CHARGING_UPPER_LIMIT] / 10
+            if self.soc < 20 and holding[HREG_AC_BOOKING_CHARGING] == 0:
+                self.ac_charging_power = 300 * max(1, holding[HREG_AC_CHARGING_RATE])
+            elif self.soc >= limit:
+                self.ac_charging_power = 0
+
+            power = self.ac_charging_power + self.dc_charging_power - self.ac_output_power
+            self.soc += power * dt / 3600 / self.CAPACITY * 100
+            self.soc = min(max(self.soc, 0), 100)
+        self.last_update = now
+
+        holding = self.holding
+        regs = self.input
+        regs[IREG_STATE_OF_CHARGE]   = int(self.soc*10)
+        regs[IREG_STATE_OF_CHARGE_1] = int(self.soc*10)
+        regs[IREG_STATE_OF_CHARGE_2] = int(self.soc*10)
+        regs[IREG_AC_OUTPUT_POWER]   = int(self.ac_output_power)
+        regs[IREG_AC_CHARGING_POWER] = int(self.ac_charging_power)
+        regs[IREG_DC_CHARGING_POWER] = int(self.dc_charging_power)
+        regs[IREG_TOTAL_INPUT_POWER] = int(self.ac_charging_power + self.dc_charging_power)
+        regs[IREG_AC_CHARGING_RATE]  = holding[HREG_AC_CHARGING_RATE]
+        regs[IREG_AC_INPUT_VOLTAGE]   = 2300 if self.ac_charging_power else 0
+        regs[IREG_AC_INPUT_FREQUENCY] = 500  if self.ac_charging_power else 0
+        regs[IREG_AC_BOOKING_CHARGING] = holding[HREG_AC_BOOKING_CHARGING]
+        regs[IREG_USB_OUTPUT_POWER_1] = 55 if holding[HREG_USB_OUTPUT] else 0
+        regs[IREG_USB_OUTPUT_POWER_2] = 0
+        regs[IREG_DC_OUTPUT_POWER_1]  = 120 if holding[HREG_DC_OUTPUT] else 0
+        regs[IREG_LED_STATE] = holding[HREG_LED] & 0x3
+        regs[IREG_LED_POWER] = 15 if regs[IREG_LED_STATE] else 0
+
+        status = 0
+        for hreg, bit in OUTPUT_STATUS_BITS.items():
+            if holding[hreg]:
+                status |= bit
+        regs[IREG_STATUS_BITS] = status
+
+        power = self.ac_charging_power + self.dc_charging_power - self.ac_output_power
+        if power > 0:
+            regs[IREG_TIME_TO_FULL]  = min(int((100-self.soc) / 100 * self.CAPACITY / power * 60), 0xFFFF)
+            regs[IREG_TIME_TO_EMPTY] = 0
+        elif power < 0:
+            regs[IREG_TIME_TO_FULL]  = 0
+            regs[IREG_TIME_TO_EMPTY] = min(int(self.soc / 100 * self.CAPACITY / -power * 60), 0xFFFF)
+        else:
+            regs[IREG_TIME_TO_FULL]  = 0
+            regs[IREG_TIME_TO_EMPTY] = 0
+
+    # Return the response to a request (a Modbus frame) or None if the
+    # request must be ignored.
+    def handle_request(self, payload:bytes, now:float):
+        if len(payload) != 8:
+            return None
+        if lesyd.modbus_crc16(payload, 6) != ((payload[6]<<8) | payload[7]):
+            return None
+        channel, func, arg1, arg2 = lesyd.MODBUS_FRAME.unpack_from(payload)
+        if channel != MODBUS_CHANNEL:
+            return None
+
+        if func == FUNC_READ_INPUT_REGISTERS or func == FUNC_READ_HOLDING_REGISTERS:
+            first, count = arg1, arg2
+            if count == 0 or first + count > REGISTER_COUNT:
+                return modbus_exception(func, ILLEGAL_DATA_ADDRESS)
+            self.update(now)
+            regs = self.input if func == FUNC_READ_INPUT_REGISTERS else self.holding
+            words = struct.pack('>%dH' % count, *regs[first:first+count])
+            return modbus_frame(lesyd.MODBUS_FRAME.pack(channel, func, first, count) + words)
+
+        if func == FUNC_WRITE_HOLDING_REGISTER:
+            hreg, value = arg1, arg2
+            if hreg >= REGISTER_COUNT:
+                return modbus_exception(func, ILLEGAL_DATA_ADDRESS)
+            self.update(now)
+            self.holding[hreg] = value
+            self.update(now)
+            # The response to a write is an echo of the request
+            return bytes(payload)
+
+        return modbus_exception(func, ILLEGAL_FUNCTION)
+
+# A fleet of simulated stations.
+#
+# process_request() is independent of the transport so the simulator can
+# also be driven in-process by the benchmarks.
+class Simulator():
+
+    # latency  the average delay of a response (in seconds)
+    # jitter   the maximal random variation of that delay (in seconds)
+    # loss     the probability that a request or its response is lost
+    def __init__(self, macs, latency:float=0.0, jitter:float=0.0, loss:float=0.0, seed=None):
+        self.stations = {}
+        for mac in macs:
+            station = SimulatedStation(mac, seed)
+            self.stations[station.topic_request] = station
+        self.latency = latency
+        self.jitter  = jitter
+        self.loss    = loss
+        self.random  = random.Random(seed)
+        self.requests  = 0
+        self.responses = 0
+        self.lost      = 0
+
+    # Return a tuple (delay, topic, response) or None
+    def process_request(self, topic:str, payload:bytes, now:float):
+        station = self.stations.get(topic)
+        if station is None:
+            return None
+        self.requests += 1
+        if self.loss and self.random.random() < self.loss:
+            self.lost += 1
+            return None
+        response = station.handle_request(payload, now)
+        if response is None:
+            return None
+        self.responses += 1
+        delay = self.latency
+        if self.jitter:
+            delay = max(0.0, delay + self.random.uniform(-self.jitter, self.jitter))
+        return (delay, station.topic_response, response)
+
+    def __str__(self):
+        return "{} stations: {} requests, {} responses, {} lost".format(
+            len(self.stations), self.requests, self.responses, self.lost)
+
+# Run a Simulator on a MQTT server.
+#
+# The delayed responses are published by a dedicated thread.
+class SimulatorClient():
+
+    def __init__(self, simulator, client):
+        self.simulator = simulator
+        self.client    = client
+        self.pending   = []   # heap of [when, seq, topic, payload]
+        self.seq       = 0
+        self.condition = threading.Condition()
+        self.logger    = logging.getLogger("lesyd_sim")
+        client.on_connect = self.on_connect
+        client.on_message = self.on_message
+
+    def on_connect(self, client, userdata, flags, reason_code, properties):
+        if reason_code.is_failure:
+            self.logger.error("Connection Failed: %s", reason_code)
+            return
+        client.subscribe('+/client/request/data')
+
+    def on_message(self, client, userdata, msg):
+        now = time.time()
+        with self.condition:
+            result = self.simulator.process_request(msg.topic, msg.payload, now)
+        if result is None:
+            return
+        delay, topic, payload = result
+        if delay <= 0:
+            client.publish(topic, payload)
+            return
+        with self.condition:
+            self.seq += 1
+            heapq.heappush(self.pending, [now+delay, self.seq, topic, payload])
+            self.condition.notify()
+
+    def publisher(self):
+        while True:
+            with self.condition:
+                while not self.pending or self.pending[0][0] > time.time():
+                    timeout = self.pending[0][0] - time.time() if self.pending else None
+                    self.condition.wait(timeout)
+                when, seq, topic, payload = heapq.heappop(self.pending)
+            self.client.publish(topic, payload)
+
+    def run(self, stats_interval:float):
+        threading.Thread(target=self.publisher, daemon=True).start()
+        self.client.loop_start()
+        while True:
+            time.sleep(stats_interval)
+            self.logger.info("%s", self.simulator)
+
+def make_macs(first:str, count:int):
+    base = int(first, 16)
+    return [ '{:012x}'.format(base+i) for i in range(count) ]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Simulate Sydpower stations for LeSyd")
+    parser.add_argument('--hostname', default='localhost')
+    parser.add_argument('--port', type=int, default=1883)
+    parser.add_argument('--username', default=None)
+    parser.add_argument('--password', default=None)
+    parser.add_argument('--count', type=int, default=1, help="The number of stations")
+    parser.add_argument('--first-mac', default='7c2c00000000', help="The MAC address of the first station")
+    parser.add_argument('--latency', type=float, default=0.05, help="The average response delay in seconds")
+    parser.add_argument('--jitter', type=float, default=0.02, help="The maximal variation of the response delay in seconds")
+    parser.add_argument('--loss', type=float, default=0.0, help="The probability that a request is lost")
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--stats', type=float, default=10, help="The interval between two statistics in seconds")
+    parser.add_argument('--preset', default='F2400-B', help="The preset used by --print-devices")
+    parser.add_argument('--print-devices', action='store_true',
+                        help="print the 'devices' section of the LeSyd configuration and quit")
+    args = parser.parse_args(argv)
+
+    macs = make_macs(args.first_mac, args.count)
+
+    if args.print_devices:
+        print("devices:")
+        for i, mac in enumerate(macs):
+            print("  '{}':\n    name: sim{}\n    preset: {}".format(mac, i, args.preset))
+        return 0
+
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO,
+                        format="[%(levelname)s] %(name)s: %(message)s")
+
+    simulator = Simulator(macs, args.latency, args.jitter, args.loss, args.seed)
+    client = lesyd.mqtt.Client(lesyd.mqtt.CallbackAPIVersion.VERSION2)
+    if args.username:
+        client.username_pw_set(args.username, args.password)
+    client.connect_async(args.hostname, args.port, keepalive=60)
+    try:
+        SimulatorClient(simulator, client).run(args.stats)
+    except KeyboardInterrupt:
+        client.loop_stop()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())